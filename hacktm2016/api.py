@@ -1,23 +1,51 @@
+import math
+
 import data
+import geo
+import metrics
+import planner
+import pubsub
+import ratt
+import responses
+import singleflight
+import upstream
 from init import app
-from flask import jsonify, request
+from flask import Response, jsonify, request
+import requests
+
+
+@app.errorhandler(requests.RequestException)
+def upstream_unavailable(e: requests.RequestException):
+	# only reached when there is no previous data to fall back on
+	response = jsonify({'error': str(e)})
+	if isinstance(e, requests.HTTPError) and e.response is not None and 400 <= e.response.status_code < 500:
+		# upstream does not know what was asked for (e.g. a line infotrafic has no page for): retrying will not help
+		response.status_code = 404
+		return response
+	response.status_code = 503
+	response.headers['Retry-After'] = '%d' % data.arrivals_poller.retry_after
+	return response
 
 
 @app.route("/api/get_stations")
 def get_stations():
-	stations = data.get_stations().values()
-	return jsonify({'stations': [station.__dict__ for station in stations]})
+	return responses.cached_json('stations', data.get_stations(), lambda stations: {
+		'stations': [station.to_json() for station in stations.values()]
+	}, max_age=3600)
 
 
 @app.route("/api/get_lines")
 def get_lines():
 	try:
-		line_types = {line_type for line_type in request.args.get("line_types").split(',') if line_type}
-		lines = [line for line in data.get_lines() if line.line_type in line_types]
+		# the other types match no line; they are kept out of the cached responses keys, which would otherwise grow
+		# with every combination clients send
+		line_types = frozenset(request.args.get("line_types").split(',')) & data.get_line_types()
 	except (AttributeError, TypeError, ValueError):
-		lines = data.get_lines()
+		line_types = None
 
-	return jsonify({'lines': [line.__dict__ for line in lines]})
+	return responses.cached_json(('lines', line_types), data.get_lines(), lambda lines: {
+		'lines': [line.to_json() for line in lines if line_types is None or line.line_type in line_types]
+	}, max_age=3600)
 
 
 @app.route("/api/get_nearby_stations")
@@ -26,45 +54,316 @@ def get_nearby_stations():
 		lat = float(request.args.get('lat'))
 		lng = float(request.args.get('lng'))
 		count = int(request.args.get('count')) if 'count' in request.args else 10
+		radius = float(request.args.get('radius')) if 'radius' in request.args else None
+		line_id = int(request.args.get('line_id')) if 'line_id' in request.args else None
+		geo.check_coordinates(lat, lng)
+		if radius is not None and not math.isfinite(radius):
+			raise ValueError("radius must be a finite number")
 	except (ValueError, TypeError) as e:
 		response = jsonify({'error': str(e)})
 		response.status_code = 400
 		return response
 
-	stations = [station for station in data.get_stations().values() if station.lat is not None and station.lng is not None]
-	sorted_list = sorted(stations, key=lambda station: ((lat - station.lat) ** 2 + (lng - station.lng) ** 2) ** 0.5)
+	predicate = None
+	if line_id is not None:
+		routes_index = data.get_station_routes_index()
+		predicate = lambda station: routes_index.serves(station.station_id, line_id)
+
+	index = data.get_stations_index()
+	if radius is not None:
+		nearby = [(distance, station) for distance, station in index.within(lat, lng, radius)
+		          if predicate is None or predicate(station)][:count]
+	else:
+		nearby = index.nearest(lat, lng, count, predicate)
 
-	return jsonify({'stations': [station.__dict__ for station in sorted_list[:count]]})
+	return jsonify({'stations': [dict(station.to_json(), distance=distance) for distance, station in nearby]})
 
 
 @app.route("/api/get_arrival_times")
 def get_arrival_times():
 	line_id = int(request.args.get('line_id'))
 	route_id = int(request.args.get('route_id'))
-	return jsonify({'arrivals': [arrival.__dict__ for arrival in data.get_arrivals(line_id)[route_id]] })
+	if line_id not in data.get_line_ids():
+		response = jsonify({'error': 'unknown line %d' % line_id})
+		response.status_code = 404
+		return response
+
+	snapshot = data.get_arrivals_snapshot(line_id)
+	return jsonify({'arrivals': [arrival.to_json() for arrival in data.get_predicted_arrivals(line_id, snapshot)[route_id]],
+	                'age': snapshot.age,
+	                'stale': data.arrivals_poller.is_stale(line_id)})
+
+
+@app.route("/api/get_arrival_times_batch", methods=['POST'])
+def get_arrival_times_batch():
+	try:
+		requested = [(int(item['line_id']), int(item['route_id'])) for item in request.get_json(force=True)['routes']]
+	except (KeyError, TypeError, ValueError) as e:
+		response = jsonify({'error': str(e)})
+		response.status_code = 400
+		return response
+
+	# unknown lines are reported as errors without asking infotrafic
+	line_ids = data.get_line_ids()
+	snapshots = data.get_arrivals_snapshots(line_id for line_id, route_id in requested if line_id in line_ids)
+	routes_list = []
+	errors = []
+	for line_id, route_id in requested:
+		snapshot = snapshots.get(line_id, None)
+		if snapshot is None or not 0 <= route_id < len(snapshot.value):
+			errors.append({'line_id': line_id, 'route_id': route_id})
+			continue
+
+		routes_list.append({'line_id': line_id, 'route_id': route_id, 'age': snapshot.age,
+		                    'stale': data.arrivals_poller.is_stale(line_id),
+		                    'arrivals': [arrival.to_json() for arrival in data.get_predicted_arrivals(line_id, snapshot)[route_id]]})
+
+	return jsonify({'routes': routes_list, 'errors': errors})
+
+
+@app.route("/api/get_station_board")
+def get_station_board():
+	try:
+		station_id = int(request.args.get('station_id'))
+	except (ValueError, TypeError) as e:
+		response = jsonify({'error': str(e)})
+		response.status_code = 400
+		return response
+
+	serving = [(line_id, route_id) for line_id, route_id, position in data.get_station_routes_index().get_by_station_id(station_id)]
+	snapshots = data.get_arrivals_snapshots(line_id for line_id, route_id in serving)
+
+	board = []
+	for line_id, route_id in serving:
+		snapshot = snapshots.get(line_id, None)
+		if snapshot is None:
+			continue
+
+		for arrival in data.get_predicted_arrivals(line_id, snapshot)[route_id]:
+			if arrival.station_id == station_id:
+				board.append(dict(arrival.to_json(), route_id=route_id, age=snapshot.age,
+				                  stale=data.arrivals_poller.is_stale(line_id)))
+
+	board.sort(key=lambda arrival: (arrival['minutes_left'] < 0, arrival['minutes_left']))
+	return jsonify({'arrivals': board})
+
+
+@app.route("/api/get_transfers")
+def get_transfers():
+	try:
+		station_id = int(request.args.get('station_id'))
+	except (ValueError, TypeError) as e:
+		response = jsonify({'error': str(e)})
+		response.status_code = 400
+		return response
+
+	table = data.get_transfer_table()
+	if station_id not in table.stops:
+		response = jsonify({'error': 'station %d is not served by any route' % station_id})
+		response.status_code = 404
+		return response
+
+	return jsonify({
+		'stops': [dict(station.to_json(), distance=distance, line_ids=line_ids)
+		          for distance, station, line_ids in table.stop_transfers(station_id)],
+		'bike_stations': [dict(bike_station.to_json(), distance=distance)
+		                  for distance, bike_station in table.bike_transfers(station_id)],
+		'stale': data.bike_stations_stale()
+	})
+
+
+@app.route("/api/get_station_lines")
+def get_station_lines():
+	index = data.get_station_routes_index()
+	if 'station_id' in request.args:
+		try:
+			stops = index.get_by_station_id(int(request.args.get('station_id')))
+		except ValueError as e:
+			response = jsonify({'error': str(e)})
+			response.status_code = 400
+			return response
+	elif 'junction_name' in request.args:
+		stops = index.get_by_junction(request.args.get('junction_name'))
+	else:
+		response = jsonify({'error': 'station_id or junction_name is required'})
+		response.status_code = 400
+		return response
+
+	return jsonify({'routes': [{'line_id': line_id, 'route_id': route_id, 'position': position}
+	                           for line_id, route_id, position in stops]})
+
+
+def _plan_endpoint(graph: planner.TransitGraph, prefix: str):
+	"""
+	Stops near a journey endpoint given either as `{prefix}_station_id` or as `{prefix}_lat` and `{prefix}_lng`.
+	"""
+	if prefix + '_station_id' in request.args:
+		stop = graph.stop_index.get(int(request.args.get(prefix + '_station_id')), None)
+		if stop is None:
+			raise ValueError("station %s is not served by any route" % request.args.get(prefix + '_station_id'))
+		return [(stop, 0.0)]
+
+	lat, lng = float(request.args.get(prefix + '_lat')), float(request.args.get(prefix + '_lng'))
+	geo.check_coordinates(lat, lng)
+	return graph.nearby_stops(lat, lng)
+
+
+@app.route("/api/plan")
+def plan():
+	graph = data.get_transit_graph()
+	try:
+		origins = _plan_endpoint(graph, 'from')
+		destinations = _plan_endpoint(graph, 'to')
+	except (ValueError, TypeError) as e:
+		response = jsonify({'error': str(e)})
+		response.status_code = 400
+		return response
+
+	# plan on the arrivals already known instead of waiting for every line to be fetched
+	arrivals = {}
+	delays = {}
+	for line_id in {line_id for line_id, route_id in graph.patterns}:
+		snapshot = data.arrivals_poller.peek(line_id)
+		if snapshot is not None:
+			for route_id, route_arrivals in enumerate(data.get_predicted_arrivals(line_id, snapshot)):
+				arrivals[(line_id, route_id)] = route_arrivals
+				delays[(line_id, route_id)] = snapshot.age / 60
+
+	departures = planner.LiveDepartures(graph, arrivals, delays)
+	return jsonify({'journeys': planner.plan(graph, departures, origins, destinations)})
+
+
+@app.route("/api/subscribe")
+def subscribe():
+	"""
+	Server-sent events stream of live updates. Subscribe to routes with `routes=line_id:route_id,...` and to bike
+	stations with `bike_stations=1`; the stream starts with a `snapshot` event per topic, followed by `diff` events
+	with the arrivals or bike stations that changed at each refresh.
+	"""
+	try:
+		routes = [tuple(int(part) for part in item.split(':')) for item in request.args.get('routes', '').split(',') if item]
+		if any(len(route) != 2 for route in routes):
+			raise ValueError("routes must be given as line_id:route_id")
+	except ValueError as e:
+		response = jsonify({'error': str(e)})
+		response.status_code = 400
+		return response
+
+	line_ids = {line_id for line_id, route_id in routes}
+	unknown = line_ids - data.get_line_ids()
+	if unknown:
+		response = jsonify({'error': 'unknown lines %s' % ', '.join(str(line_id) for line_id in sorted(unknown))})
+		response.status_code = 404
+		return response
+
+	topics = [data.arrivals_topic(line_id, route_id) for line_id, route_id in routes]
+	if request.args.get('bike_stations'):
+		topics.append(data.bike_stations_topic)
+	if not topics:
+		response = jsonify({'error': 'nothing to subscribe to'})
+		response.status_code = 400
+		return response
+
+	def refresh():
+		# reading the snapshots refreshes stale ones even when the pollers are not running
+		data.get_arrivals_snapshots(line_ids)
+		if data.bike_stations_topic in topics:
+			data.get_bike_stations()
+
+	# the first snapshots are read before answering, so that an upstream failure is an error response rather than a
+	# stream cut short after its headers went out
+	refresh()
+	subscription = data.hub.subscribe(topics)
+
+	def stream():
+		try:
+			for topic in topics:
+				yield pubsub.format_event('snapshot', {'topic': topic, 'items': data.diff_publisher.state(topic)})
+
+			for event in subscription.events(timeout=15):
+				if event is None:
+					try:
+						refresh()
+						event = ": keep-alive\n\n"
+					except requests.RequestException as e:
+						event = pubsub.format_event('error', {'error': str(e)})
+				yield event
+		finally:
+			data.hub.unsubscribe(subscription)
+
+	return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route("/api/get_poller_stats")
+def get_poller_stats():
+	return jsonify({'pollers': [data_poller.stats() for data_poller in data.pollers],
+	                'history': data.arrival_history.stats() if data.arrival_history is not None else None})
+
+
+@app.route("/api/get_subscription_stats")
+def get_subscription_stats():
+	return jsonify(data.hub.stats())
+
+
+@app.route("/api/get_cache_stats")
+def get_cache_stats():
+	return jsonify(data.cache.stats())
+
+
+@app.route("/api/get_upstream_stats")
+def get_upstream_stats():
+	return jsonify(upstream.stats())
+
+
+@app.route("/api/get_station_times_stats")
+def get_station_times_stats():
+	return jsonify(ratt.station_times.stats())
+
+
+@app.route("/api/get_singleflight_stats")
+def get_singleflight_stats():
+	return jsonify(singleflight.default.stats())
+
+
+@app.route("/metrics")
+def get_metrics():
+	return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route("/api/get_routes")
 def get_routes():
-	line_id = int(request.args.get('line_id'))
-	all_routes = data.get_routes()
+	try:
+		line_id = int(request.args.get('line_id'))
+	except (ValueError, TypeError) as e:
+		response = jsonify({'error': str(e)})
+		response.status_code = 400
+		return response
 
-	routes = all_routes[line_id]
-	routes_list = []
+	all_routes = data.get_routes()
+	if line_id not in all_routes:
+		response = jsonify({'error': 'no routes known for line %d' % line_id})
+		response.status_code = 404
+		return response
 
-	for route in routes:
-		stations_dict = []
-		for station in route.stations:
-			stations_dict.append(station.__dict__)
+	return responses.cached_json(('routes', line_id), all_routes, lambda all_routes: {
+		'routes': [route.to_json() for route in all_routes[line_id]]
+	}, max_age=3600)
 
-		routes_list.append({'line_id': route.line_id, 'route_id': route.route_id, 'route_name': route.route_name, 'stations': stations_dict})
 
-	return jsonify({'routes': routes_list})
+@app.route("/api/get_route_changes")
+def get_route_changes():
+	"""
+	Lines and stations added to or removed from the routes since the server started, oldest first. Only the worker
+	scraping infotrafic records changes.
+	"""
+	return jsonify({'changes': list(data.route_discovery.changes), 'stats': data.route_discovery.stats()})
 
 
 @app.route("/api/get_bike_stations")
 def get_bike_stations():
-	return jsonify({'bike_stations': [station.__dict__ for station in data.get_bike_stations()]})
+	return responses.cached_json('bike_stations', data.get_bike_stations(), lambda bike_stations: {
+		'bike_stations': [station.to_json() for station in bike_stations]
+	}, max_age=30, stale=data.bike_stations_stale())
 
 
 @app.route("/api/get_closest_bike_station")
@@ -72,11 +371,17 @@ def get_closest_bike_station():
 	try:
 		lat = float(request.args.get('lat'))
 		lng = float(request.args.get('lng'))
+		geo.check_coordinates(lat, lng)
 	except (ValueError, TypeError) as e:
 		response = jsonify({'error': str(e)})
 		response.status_code = 400
 		return response
 
-	sorted_list = sorted(data.get_bike_stations(), key=lambda station: ((lat - station.lat) ** 2 + (lng - station.lng) ** 2) ** 0.5)
+	nearest = data.get_bike_stations_index().nearest(lat, lng)
+	if not nearest:
+		response = jsonify({'error': 'no bike stations available'})
+		response.status_code = 404
+		return response
 
-	return jsonify(sorted_list[0].__dict__)
+	distance, station = nearest[0]
+	return jsonify(dict(station.to_json(), distance=distance, stale=data.bike_stations_stale()))
@@ -0,0 +1,92 @@
+import time
+from typing import Any, Callable, Dict, Hashable, List, Sequence
+
+import gevent
+from gevent.event import AsyncResult
+
+import caching
+
+_missing = object()
+
+
+class Batcher:
+	"""
+	Collects the keys looked up by concurrent callers during a short time window and fetches them together with a
+	single `fetch_many(keys)` call; keys already queued or in flight are not fetched twice, and fetched values are
+	cached per key for `expire` seconds.
+
+	Parameters
+	----------
+	fetch_many function fetching the values of a list of keys, returning them in the same order, with None for the
+	           keys that could not be fetched (which are not cached)
+	window seconds to wait for other lookups before fetching
+	expire time to live of the cached values, in seconds
+	max_entries size bound of the cache
+	"""
+
+	def __init__(self, fetch_many: Callable[[List[Hashable]], List[Any]], window: float = 0.02, expire: float = 30,
+	             max_entries: int = 10000):
+		self.fetch_many = fetch_many
+		self.window = window
+		self.expire = expire
+		self.cache = caching.LRUCache(max_entries)
+		self._pending = {}  # type: Dict[Hashable, AsyncResult]
+		self._queued = []  # type: List[Hashable]
+		self._flusher = None  # type: gevent.Greenlet
+		self.batches = self.fetched = self.failed = self.coalesced = 0
+
+	def get_many(self, keys: Sequence[Hashable]) -> List[Any]:
+		"""
+		Look up several keys, waiting for the ones that are not cached to be fetched.
+
+		Returns
+		-------
+		Values in the order of `keys`, with None for the keys that could not be fetched
+		"""
+		values = [None] * len(keys)  # type: List[Any]
+		waiting = []
+		for index, key in enumerate(keys):
+			value = self.cache.get(key, _missing)
+			if value is not _missing:
+				values[index] = value
+				continue
+
+			pending = self._pending.get(key, None)
+			if pending is None:
+				pending = self._pending[key] = AsyncResult()
+				self._queued.append(key)
+				if self._flusher is None:
+					self._flusher = gevent.spawn_later(self.window, self._flush)
+			else:
+				self.coalesced += 1
+			waiting.append((index, pending))
+
+		for index, pending in waiting:
+			values[index] = pending.get()
+		return values
+
+	def get(self, key: Hashable) -> Any:
+		return self.get_many([key])[0]
+
+	def _flush(self):
+		keys, self._queued, self._flusher = self._queued, [], None
+		self.batches += 1
+		try:
+			values = self.fetch_many(keys)
+		except Exception as e:
+			for key in keys:
+				self._pending.pop(key).set_exception(e)
+			return
+
+		expires_at = time.time() + self.expire
+		for key, value in zip(keys, values):
+			if value is not None:
+				self.fetched += 1
+				self.cache.set(key, value, expires_at)
+			else:
+				self.failed += 1
+			self._pending.pop(key).set(value)
+
+	def stats(self) -> Dict[str, Any]:
+		return {'batches': self.batches, 'fetched': self.fetched, 'failed': self.failed, 'coalesced': self.coalesced,
+		        'pending': len(self._pending), 'cache': self.cache.stats()}
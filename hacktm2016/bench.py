@@ -0,0 +1,503 @@
+"""
+Benchmarks for the hacktm2016 application.
+
+Usage: python bench.py [benchmark ...] [--pages DIR] [--json FILE] [load test options]
+
+Pages recorded from the upstream servers can be given with --pages (files named after the upstream path, e.g.
+sens0.php?param1=1106.html, as written by `python simulator.py --record DIR`); otherwise synthetic pages built from
+the known lines and stations are used.
+
+The load benchmark runs the application and the upstream simulator as separate processes and drives every API
+endpoint with concurrent requests.
+"""
+
+import argparse
+import concurrent.futures
+import copy
+import glob
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pytz
+import requests
+
+import data
+import importer
+import planner
+import ratt
+import simulator
+
+benchmarks = {}  # type: Dict[str, Callable[[argparse.Namespace], Dict[str, Any]]]
+
+
+def benchmark(name: str):
+	def decorator(func):
+		benchmarks[name] = func
+		return func
+	return decorator
+
+
+def timeit(func: Callable[[], Any], min_time: float = 1.0) -> Dict[str, float]:
+	"""
+	Call `func` repeatedly for at least `min_time` seconds.
+
+	Returns
+	-------
+	Number of calls, mean and best time per call in seconds
+	"""
+	times = []
+	deadline = time.perf_counter() + min_time
+	while not times or time.perf_counter() < deadline:
+		started = time.perf_counter()
+		func()
+		times.append(time.perf_counter() - started)
+
+	return {'calls': len(times), 'mean': sum(times) / len(times), 'best': min(times)}
+
+
+class FakeResponse:
+	"""
+	Stand-in for a requests.Response holding a recorded or synthetic page.
+	"""
+
+	status_code = 200
+
+	def __init__(self, text: str, url: str = ''):
+		self.text = text
+		self.url = url
+
+	def raise_for_status(self):
+		pass
+
+	def close(self):
+		pass
+
+
+def load_infotrafic_pages(args: argparse.Namespace) -> Dict[int, FakeResponse]:
+	pages = {}
+	if args.pages:
+		for filename in glob.glob(os.path.join(args.pages, 'sens0.php*')):
+			line_id = int(re.search(r"param1=(\d+)", filename).group(1))
+			with open(filename, encoding='utf-8') as page:
+				pages[line_id] = FakeResponse(page.read(), filename)
+	else:
+		random.seed(2016)
+		stations = [station for station in data.get_stations().values()]
+		for line in data.get_lines():
+			route_stations = random.sample(stations, 25)
+			pages[line.line_id] = FakeResponse(simulator.synthetic_infotrafic_page(line, route_stations))
+
+	return pages
+
+
+def csv_routes() -> Dict[int, Tuple[ratt.Route, ratt.Route]]:
+	"""
+	Approximate the routes of every line from the known stations file, which lists the stations of each line in
+	order; the second route of a line is taken as the first one reversed.
+	"""
+	lines = {line.line_id: line for line in data.get_lines()}
+	return {line_id: (ratt.Route(0, lines[line_id].route_name_1, line_id, route_stations),
+	                  ratt.Route(1, lines[line_id].route_name_2, line_id, route_stations[::-1]))
+	        for line_id, route_stations in simulator.line_stations().items()}
+
+
+def synthetic_arrivals(routes: Dict[int, Tuple[ratt.Route, ratt.Route]]) -> Dict[Tuple[int, int], List[ratt.Arrival]]:
+	"""
+	Arrivals with a vehicle every few stops of every route, moving at about 2 minutes per stop.
+	"""
+	arrivals = {}
+	for line_id, line_routes in routes.items():
+		for route in line_routes:
+			offset = random.randint(0, 10)
+			arrivals[(line_id, route.route_id)] = [
+				ratt.Arrival(line_id, station.station_id, "%d min." % ((offset + 2 * position) % 15), (offset + 2 * position) % 15, True)
+				for position, station in enumerate(route.stations)
+			]
+	return arrivals
+
+
+@benchmark('plan')
+def bench_plan(args: argparse.Namespace) -> Dict[str, Any]:
+	random.seed(2016)
+	routes = csv_routes()
+	started = time.perf_counter()
+	graph = planner.TransitGraph(routes)
+	build_time = time.perf_counter() - started
+
+	arrivals = synthetic_arrivals(routes)
+	started = time.perf_counter()
+	departures = planner.LiveDepartures(graph, arrivals)
+	departures_time = time.perf_counter() - started
+
+	located = [station for station in graph.stations if station.lat is not None]
+	queries = [(random.choice(located), random.choice(located)) for _ in range(200)]
+	found = []
+
+	def run():
+		found.clear()
+		for origin, destination in queries:
+			journeys = planner.plan(graph, departures, graph.nearby_stops(origin.lat, origin.lng),
+			                        graph.nearby_stops(destination.lat, destination.lng))
+			found.append(bool(journeys))
+
+	timing = timeit(run)
+	return {'stops': len(graph.stations), 'patterns': len(graph.patterns), 'graph_build_seconds': build_time,
+	        'departures_build_seconds': departures_time, 'queries': len(queries),
+	        'queries_with_journeys': sum(found), 'mean_query_seconds': timing['mean'] / len(queries)}
+
+
+class DictBacked:
+	"""
+	Object keeping the attributes of a domain object in an instance __dict__, i.e. the representation used before
+	the domain classes got __slots__.
+	"""
+
+	def __init__(self, obj: Any, converted: Dict[int, 'DictBacked']):
+		for name in type(obj).__slots__:
+			value = getattr(obj, name)
+			if name == 'stations':
+				value = [DictBacked.convert(station, converted) for station in value]
+			setattr(self, name, value)
+
+	@staticmethod
+	def convert(obj: Any, converted: Dict[int, 'DictBacked']) -> 'DictBacked':
+		"""
+		Convert `obj`, reusing the conversion of objects converted before so that shared references stay shared.
+		"""
+		result = converted.get(id(obj), None)
+		if result is None:
+			result = converted[id(obj)] = DictBacked(obj, converted)
+		return result
+
+
+def domain_objects(routes: Dict[int, Tuple[ratt.Route, ratt.Route]]) -> List[Any]:
+	arrivals = synthetic_arrivals(routes)
+	objects = list(data.get_stations().values()) + list(data.get_lines())
+	objects += [route for line_routes in routes.values() for route in line_routes]
+	objects += [arrival for route_arrivals in arrivals.values() for arrival in route_arrivals]
+	return objects
+
+
+def measure_memory(build: Callable[[], Any]) -> int:
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		kept = build()
+		return tracemalloc.get_traced_memory()[0] - before
+	finally:
+		del kept
+		tracemalloc.stop()
+
+
+@benchmark('model')
+def bench_model(args: argparse.Namespace) -> Dict[str, Any]:
+	random.seed(2016)
+	objects = domain_objects(csv_routes())
+
+	def copy_slots():
+		copied = {}
+		for obj in objects:
+			copied[id(obj)] = copy.copy(obj)
+			if isinstance(obj, ratt.Route):
+				copied[id(obj)].stations = [copied.get(id(station), station) for station in obj.stations]
+		return copied
+
+	def convert_dict_backed():
+		converted = {}
+		for obj in objects:
+			DictBacked.convert(obj, converted)
+		return converted
+
+	result = {'objects': len(objects)}
+	result['slots_bytes'] = measure_memory(copy_slots)
+	result['dict_bytes'] = measure_memory(convert_dict_backed)
+
+	dict_backed = list(convert_dict_backed().values())
+	as_dict = lambda obj: dict(obj.__dict__, stations=[station.__dict__ for station in obj.stations]) if hasattr(obj, 'stations') else obj.__dict__
+	result['to_json'] = timeit(lambda: json.dumps([obj.to_json() for obj in objects]))
+	result['__dict__'] = timeit(lambda: json.dumps([as_dict(obj) for obj in dict_backed]))
+	return result
+
+
+@benchmark('parse_infotrafic')
+def bench_parse_infotrafic(args: argparse.Namespace) -> Dict[str, Any]:
+	pages = load_infotrafic_pages(args)
+	for line_id, page in pages.items():
+		fast = ratt._infotrafic_rows_fast(page.text)
+		if fast != ratt._infotrafic_rows_bs4(page.text):
+			raise AssertionError("fast parser output differs from BeautifulSoup for line %d%s"
+			                     % (line_id, " (fast parser declined)" if fast is None else ""))
+
+	total_bytes = sum(len(page.text) for page in pages.values())
+	result = {'pages': len(pages), 'bytes': total_bytes}
+	for name, parse in (('bs4', ratt._infotrafic_rows_bs4), ('fast', ratt._infotrafic_rows_fast)):
+		timing = timeit(lambda: [parse(page.text) for page in pages.values()])
+		timing['pages_per_second'] = len(pages) / timing['mean']
+		timing['mb_per_second'] = total_bytes / timing['mean'] / 1e6
+		result[name] = timing
+
+	return result
+
+
+def arrival_strings(args: argparse.Namespace) -> List[str]:
+	"""
+	Arrival strings of the recorded or synthetic infotrafic pages, plus edge cases of every format.
+	"""
+	arrivals = []
+	for page in load_infotrafic_pages(args).values():
+		arrivals.extend(cols[2] for bgcolor, cols in ratt._infotrafic_rows_fast(page.text) if len(cols) > 2)
+	arrivals += ["0:00", "00:00", "23:59", "24:00", "9:5", "12:60", "1 min", "1min.", "15 min.", " >> ", ">", "**:**",
+	             "xx:xx", "", " 7 min.", "5 min.\n"]
+	return arrivals
+
+
+def check_parse_arrivals(arrivals: List[str], now: datetime):
+	expected = [ratt.parse_arrival(now, 1, 1, arrival) for arrival in arrivals]
+	parsed = ratt.parse_arrivals(now, 1, [1] * len(arrivals), arrivals)
+	for arrival, want, got in zip(arrivals, expected, parsed):
+		if (want.arrival, want.minutes_left, want.is_real_time) != (got.arrival, got.minutes_left, got.is_real_time):
+			raise AssertionError("parse_arrivals(%r) at %s gave %r instead of %r" % (arrival, now, got, want))
+
+
+@benchmark('parse_arrival')
+def bench_parse_arrival(args: argparse.Namespace) -> Dict[str, Any]:
+	arrivals = arrival_strings(args)
+
+	# every minute of a normal day and of the days the clocks change, and a time with seconds
+	rng = random.Random(2016)
+	nows = [ratt.timezone.localize(datetime(2016, 4, 9, 12, 34, 56))]
+	for day in (datetime(2016, 4, 9), datetime(2016, 3, 27), datetime(2016, 10, 30)):
+		start = ratt.timezone.localize(day).astimezone(pytz.utc)
+		nows += [(start + timedelta(minutes=minute)).astimezone(ratt.timezone) for minute in range(0, 25 * 60, 7)]
+	for now in nows:
+		check_parse_arrivals(rng.sample(arrivals, min(50, len(arrivals))), now)
+
+	now = ratt.timezone.localize(datetime(2016, 4, 9, 12, 0))
+	station_ids = [1] * len(arrivals)
+	result = {'arrivals': len(arrivals), 'checked_times': len(nows)}
+	result['parse_arrival'] = timeit(lambda: [ratt.parse_arrival(now, 1, 1, arrival) for arrival in arrivals])
+	result['parse_arrivals'] = timeit(lambda: ratt.parse_arrivals(now, 1, station_ids, arrivals))
+	dst_now = ratt.timezone.localize(datetime(2016, 10, 30, 12, 0))
+	result['parse_arrivals_dst_day'] = timeit(lambda: ratt.parse_arrivals(dst_now, 1, station_ids, arrivals))
+	for name in ('parse_arrival', 'parse_arrivals', 'parse_arrivals_dst_day'):
+		result[name]['arrivals_per_second'] = len(arrivals) / result[name]['mean']
+	return result
+
+
+@benchmark('parse_arrivals')
+def bench_parse_arrivals(args: argparse.Namespace) -> Dict[str, Any]:
+	pages = load_infotrafic_pages(args)
+	stations = data.get_stations()
+	timing = timeit(lambda: [ratt.parse_arrivals_from_infotrafic(line_id, stations, page) for line_id, page in pages.items()])
+	timing['pages_per_second'] = len(pages) / timing['mean']
+	return {'pages': len(pages), 'parse_arrivals_from_infotrafic': timing}
+
+
+@benchmark('importer')
+def bench_importer(args: argparse.Namespace) -> Dict[str, Any]:
+	stations = importer._import_stations(data.known_stations_csv)
+	lines = importer._import_lines(data.known_lines_csv)
+	return {'stations': len(stations.stations), 'lines': len(lines.lines),
+	        'import_stations': timeit(lambda: importer._import_stations(data.known_stations_csv)),
+	        'import_lines': timeit(lambda: importer._import_lines(data.known_lines_csv)),
+	        'import_stations_memoized': timeit(lambda: importer.import_stations(data.known_stations_csv))}
+
+
+def free_port() -> int:
+	with socket.socket() as sock:
+		sock.bind(('localhost', 0))
+		return sock.getsockname()[1]
+
+
+def start_process(arguments: List[str], env: Dict[str, str], ready_url: str, timeout: float = 60) -> subprocess.Popen:
+	"""
+	Start a python script and wait until `ready_url` answers.
+	"""
+	process = subprocess.Popen([sys.executable] + arguments, env=dict(os.environ, **env),
+	                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	deadline = time.time() + timeout
+	while True:
+		try:
+			requests.get(ready_url, timeout=1)
+			return process
+		except requests.RequestException:
+			if process.poll() is not None or time.time() > deadline:
+				process.kill()
+				raise RuntimeError("%s did not start" % " ".join(arguments))
+			time.sleep(0.2)
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def load_test(send: Callable[[requests.Session], int], count: int, concurrency: int) -> Dict[str, Any]:
+	"""
+	Call `send` `count` times from `concurrency` threads, each with its own session.
+
+	Returns
+	-------
+	Throughput, latency percentiles in seconds and number of responses per status code
+	"""
+	sessions = threading.local()
+
+	def timed():
+		if not hasattr(sessions, 'session'):
+			sessions.session = requests.Session()
+		started = time.perf_counter()
+		try:
+			status = send(sessions.session)
+		except requests.RequestException as e:
+			status = type(e).__name__
+		return status, time.perf_counter() - started
+
+	started = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+		results = list(executor.map(lambda _: timed(), range(count)))
+	elapsed = time.perf_counter() - started
+
+	latencies = [latency for status, latency in results]
+	statuses = {}
+	for status, latency in results:
+		statuses[str(status)] = statuses.get(str(status), 0) + 1
+	return {'requests': count, 'requests_per_second': count / elapsed, 'statuses': statuses,
+	        'p50': percentile(latencies, 0.5), 'p90': percentile(latencies, 0.9), 'p99': percentile(latencies, 0.99),
+	        'max': max(latencies)}
+
+
+def load_endpoints(base_url: str) -> Dict[str, Callable[[requests.Session], int]]:
+	"""
+	A representative request to every API endpoint, as functions sending it and returning the status code.
+	"""
+	rng = random.Random(2016)
+	line_stations = simulator.line_stations()
+	line_ids = sorted(line_stations)
+	located = [station for stations in line_stations.values() for station in stations if station.lat is not None]
+
+	def get(path: str, params: Callable[[], Dict[str, Any]] = dict):
+		return lambda session: session.get(base_url + path, params=params(), timeout=60).status_code
+
+	def station_params():
+		return {'station_id': rng.choice(located).station_id}
+
+	def point_params(prefix: str = ''):
+		station = rng.choice(located)
+		return {prefix + 'lat': station.lat + rng.uniform(-0.003, 0.003), prefix + 'lng': station.lng + rng.uniform(-0.003, 0.003)}
+
+	def arrival_times_batch(session: requests.Session) -> int:
+		routes = [{'line_id': line_id, 'route_id': rng.randint(0, 1)} for line_id in rng.sample(line_ids, 5)]
+		return session.post(base_url + '/api/get_arrival_times_batch', json={'routes': routes}, timeout=60).status_code
+
+	def subscribe(session: requests.Session) -> int:
+		# time to the first event of the stream
+		params = {'routes': '%d:0' % rng.choice(line_ids), 'bike_stations': 1}
+		with session.get(base_url + '/api/subscribe', params=params, stream=True, timeout=60) as response:
+			next(response.iter_lines())
+			return response.status_code
+
+	return {
+		'get_stations': get('/api/get_stations'),
+		'get_lines': get('/api/get_lines', lambda: {'line_types': 'tram,trolley'}),
+		'get_routes': get('/api/get_routes', lambda: {'line_id': rng.choice(line_ids)}),
+		'get_route_changes': get('/api/get_route_changes'),
+		'get_nearby_stations': get('/api/get_nearby_stations', point_params),
+		'get_arrival_times': get('/api/get_arrival_times', lambda: {'line_id': rng.choice(line_ids), 'route_id': rng.randint(0, 1)}),
+		'get_arrival_times_batch': arrival_times_batch,
+		'get_station_board': get('/api/get_station_board', station_params),
+		'get_station_lines': get('/api/get_station_lines', station_params),
+		'get_transfers': get('/api/get_transfers', station_params),
+		'plan': get('/api/plan', lambda: dict(point_params('from_'), **point_params('to_'))),
+		'subscribe': subscribe,
+		'get_bike_stations': get('/api/get_bike_stations'),
+		'get_closest_bike_station': get('/api/get_closest_bike_station', point_params),
+		'get_poller_stats': get('/api/get_poller_stats'),
+		'get_subscription_stats': get('/api/get_subscription_stats'),
+		'get_cache_stats': get('/api/get_cache_stats'),
+		'get_upstream_stats': get('/api/get_upstream_stats'),
+		'get_singleflight_stats': get('/api/get_singleflight_stats'),
+		'get_station_times_stats': get('/api/get_station_times_stats'),
+		'metrics': get('/metrics'),
+	}
+
+
+@benchmark('load')
+def bench_load(args: argparse.Namespace) -> Dict[str, Any]:
+	simulator_port, server_port = free_port(), free_port()
+	simulator_url = 'http://localhost:%d/' % simulator_port
+	base_url = 'http://localhost:%d' % server_port
+	simulator_args = ['simulator.py', '--port', str(simulator_port), '--latency', str(args.latency),
+	                  '--jitter', str(args.jitter), '--failure-rate', str(args.failure_rate)]
+	if args.pages:
+		simulator_args += ['--recordings', args.pages]
+
+	with tempfile.TemporaryDirectory() as directory:
+		env = {'SERVER_PORT': str(server_port), 'SNAPSHOT_FILE': os.path.join(directory, 'snapshot.db'),
+		       'HISTORY_FILE': os.path.join(directory, 'history.db'), 'CACHE_SHARED': '',
+		       'INFOTRAFIC_URL': simulator_url + 'html/timpi/', 'RATT_TXT_URL': simulator_url + 'txt/',
+		       'VELO_URL': simulator_url}
+		upstream_process = start_process(simulator_args, {}, simulator_url + 'stats')
+		server_process = None
+		try:
+			server_process = start_process(['runserver.py'], env, base_url + '/api/get_lines')
+			started = time.perf_counter()
+			requests.get(base_url + '/api/get_routes', params={'line_id': data.get_lines()[0].line_id}, timeout=300)
+			result = {'route_discovery_seconds': time.perf_counter() - started, 'endpoints': {}}
+
+			for name, send in sorted(load_endpoints(base_url).items()):
+				print("  load testing %s..." % name, file=sys.stderr)
+				result['endpoints'][name] = load_test(send, args.requests, args.concurrency)
+
+			result['upstream'] = requests.get(simulator_url + 'stats').json()
+		finally:
+			if server_process is not None:
+				server_process.kill()
+			upstream_process.kill()
+
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run hacktm2016 benchmarks.")
+	parser.add_argument('names', nargs='*', metavar='benchmark',
+	                    help="benchmarks to run, any of: %s (default: all)" % ", ".join(sorted(benchmarks)))
+	parser.add_argument('--pages', help="directory with recorded upstream pages")
+	parser.add_argument('--json', help="write results to this file as JSON")
+	load_options = parser.add_argument_group("load test options")
+	load_options.add_argument('--requests', type=int, default=200, help="requests per endpoint (default: 200)")
+	load_options.add_argument('--concurrency', type=int, default=20, help="concurrent clients (default: 20)")
+	load_options.add_argument('--latency', type=float, default=0.05, help="simulated upstream latency in seconds")
+	load_options.add_argument('--jitter', type=float, default=0.02, help="simulated upstream latency jitter in seconds")
+	load_options.add_argument('--failure-rate', type=float, default=0.0, help="simulated upstream failure rate")
+	args = parser.parse_args()
+	unknown = set(args.names) - set(benchmarks)
+	if unknown:
+		parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+	results = {'meta': {'started_at': time.time(), 'python': platform.python_version(), 'platform': platform.platform()}}
+	for name in args.names or sorted(benchmarks):
+		print("running %s..." % name, file=sys.stderr)
+		results[name] = benchmarks[name](args)
+		print(json.dumps(results[name], indent=2, sort_keys=True))
+
+	if args.json:
+		with open(args.json, 'w') as output:
+			json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+	main()
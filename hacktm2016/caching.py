@@ -0,0 +1,254 @@
+import collections
+import functools
+import hashlib
+import pickle
+import sqlite3
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+_missing = object()
+
+
+class LRUCache:
+	"""
+	In-process cache holding live Python objects, bounded by entry count, with a time-to-live per entry.
+	"""
+
+	def __init__(self, max_entries: int = 1024):
+		self.max_entries = max_entries
+		self._entries = collections.OrderedDict()  # type: Dict[Hashable, Tuple[float, Any]]
+		self.hits = self.misses = self.evictions = self.expirations = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key: Hashable, default: Any = None) -> Any:
+		entry = self._entries.get(key, None)
+		if entry is None:
+			self.misses += 1
+			return default
+
+		expires_at, value = entry
+		if expires_at <= time.time():
+			del self._entries[key]
+			self.expirations += 1
+			self.misses += 1
+			return default
+
+		self._entries.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def set(self, key: Hashable, value: Any, expires_at: float):
+		self._entries[key] = (expires_at, value)
+		self._entries.move_to_end(key)
+		while len(self._entries) > self.max_entries:
+			self._entries.popitem(last=False)
+			self.evictions += 1
+
+	def delete(self, key: Hashable):
+		self._entries.pop(key, None)
+
+	def stats(self) -> Dict[str, int]:
+		return {'entries': len(self._entries), 'max_entries': self.max_entries, 'hits': self.hits,
+		        'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class SqliteStore:
+	"""
+	Shared cache tier backed by a sqlite database file, usable by several worker processes on the same host.
+	"""
+
+	def __init__(self, filename: str):
+		self.filename = filename
+		self.reconnect()
+		self.hits = self.misses = 0
+
+	def reconnect(self):
+		"""
+		Open a new connection to the database; must be called in a forked child before using the store.
+		"""
+		self._db = sqlite3.connect(self.filename, timeout=10, isolation_level=None, check_same_thread=False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL, value BLOB)")
+
+	def get(self, key: str) -> Tuple[Any, float]:
+		row = self._db.execute("SELECT expires_at, value FROM cache WHERE key = ? AND expires_at > ?",
+		                       (key, time.time())).fetchone()
+		if row is None:
+			self.misses += 1
+			return _missing, 0
+
+		self.hits += 1
+		return pickle.loads(row[1]), row[0]
+
+	def set(self, key: str, value: Any, expires_at: float):
+		self._db.execute("INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)",
+		                 (key, expires_at, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+		self._db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+
+	def delete(self, key: str):
+		self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+	def stats(self) -> Dict[str, Any]:
+		return {'type': 'sqlite', 'filename': self.filename, 'hits': self.hits, 'misses': self.misses}
+
+
+class MemcachedStore:
+	"""
+	Shared cache tier backed by memcached. Requires the optional `pymemcache` package.
+	"""
+
+	def __init__(self, host: str, port: int = 11211):
+		self.server = (host, port)
+		self.reconnect()
+		self.hits = self.misses = 0
+
+	def reconnect(self):
+		"""
+		Open a new connection to memcached; must be called in a forked child before using the store.
+		"""
+		from pymemcache.client.base import Client
+		self._client = Client(self.server, connect_timeout=1, timeout=1)
+
+	@staticmethod
+	def _key(key: str) -> str:
+		return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+	def get(self, key: str) -> Tuple[Any, float]:
+		data = self._client.get(self._key(key))
+		if data is None:
+			self.misses += 1
+			return _missing, 0
+
+		expires_at, value = pickle.loads(data)
+		if expires_at <= time.time():
+			self.misses += 1
+			return _missing, 0
+
+		self.hits += 1
+		return value, expires_at
+
+	def set(self, key: str, value: Any, expires_at: float):
+		data = pickle.dumps((expires_at, value), pickle.HIGHEST_PROTOCOL)
+		self._client.set(self._key(key), data, expire=max(1, int(expires_at - time.time()) + 1))
+
+	def delete(self, key: str):
+		self._client.delete(self._key(key))
+
+	def stats(self) -> Dict[str, Any]:
+		return {'type': 'memcached', 'server': '%s:%d' % self.server, 'hits': self.hits, 'misses': self.misses}
+
+
+class TieredCache:
+	"""
+	Two-tier cache: an in-process LRU in front of an optional shared store.
+
+	Values found in the shared store are copied into the local tier for their remaining lifetime, so each worker
+	only deserializes a shared value once.
+	"""
+
+	def __init__(self, local: LRUCache, shared=None):
+		self.local = local
+		self.shared = shared
+		self.namespace_stats = {}  # type: Dict[str, Dict[str, int]]
+
+	def get(self, key: Tuple[str, Hashable], shared: bool = True, default: Any = _missing) -> Any:
+		value = self.local.get(key, _missing)
+		if value is _missing and shared and self.shared is not None:
+			value, expires_at = self.shared.get(repr(key))
+			if value is not _missing:
+				self.local.set(key, value, expires_at)
+
+		stats = self.namespace_stats.setdefault(key[0], {'hits': 0, 'misses': 0})
+		stats['hits' if value is not _missing else 'misses'] += 1
+		return value if value is not _missing else default
+
+	def set(self, key: Tuple[str, Hashable], value: Any, expire: float, shared: bool = True):
+		expires_at = time.time() + expire
+		self.local.set(key, value, expires_at)
+		if shared and self.shared is not None:
+			self.shared.set(repr(key), value, expires_at)
+
+	def delete(self, key: Tuple[str, Hashable]):
+		self.local.delete(key)
+		if self.shared is not None:
+			self.shared.delete(repr(key))
+
+	def cache(self, namespace: str, expire: float, shared: bool = True) -> Callable[[Callable], Callable]:
+		"""
+		Decorator caching the results of a function per positional arguments.
+
+		Parameters
+		----------
+		namespace cache key prefix, unique per function
+		expire time to live of the cached values, in seconds
+		shared whether values are also stored in the shared tier; disable for values that are cheap to rebuild
+		       from other cached values or that should not be pickled
+		"""
+		def decorator(func):
+			@functools.wraps(func)
+			def wrapper(*args):
+				key = (namespace, args)
+				value = self.get(key, shared)
+				if value is _missing:
+					value = func(*args)
+					self.set(key, value, expire, shared)
+				return value
+
+			wrapper.invalidate = lambda *args: self.delete((namespace, args))
+			return wrapper
+
+		return decorator
+
+	def stats(self) -> Dict[str, Any]:
+		return {'local': self.local.stats(), 'shared': self.shared.stats() if self.shared is not None else None,
+		        'namespaces': self.namespace_stats}
+
+
+def derived(source: Callable[[], Any]) -> Callable[[Callable], Callable]:
+	"""
+	Decorator for argument-less functions computing a value from the result of `source()`, typically another cached
+	function. The value is recomputed only when `source()` returns a different object, i.e. after its cache entry was
+	refreshed.
+	"""
+	def decorator(func):
+		memo = [_missing, None]  # [source value, derived value]
+
+		@functools.wraps(func)
+		def wrapper():
+			value = source()
+			if memo[0] is not value:
+				memo[1] = func(value)
+				memo[0] = value
+			return memo[1]
+
+		return wrapper
+
+	return decorator
+
+
+def make_shared_store(url: str) -> Optional[Any]:
+	"""
+	Create a shared cache store from an url of the form "sqlite:///path/to/file.db" or "memcached://host:port".
+	"""
+	if not url:
+		return None
+	if url.startswith('sqlite://'):
+		return SqliteStore(url[len('sqlite://'):])
+	if url.startswith('memcached://'):
+		host, _, port = url[len('memcached://'):].partition(':')
+		return MemcachedStore(host, int(port) if port else 11211)
+
+	raise ValueError("unsupported shared cache url: %r" % url)
+
+
+def from_config(options: Dict[str, str]) -> TieredCache:
+	"""
+	Create a cache from a dict of options:
+
+	- cache.max_entries: size bound of the in-process tier
+	- cache.shared: url of the shared tier, see `make_shared_store`; empty for none
+	"""
+	local = LRUCache(int(options.get('cache.max_entries', 1024)))
+	return TieredCache(local, make_shared_store(options.get('cache.shared', '')))
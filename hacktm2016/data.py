@@ -1,42 +1,359 @@
-from beaker.cache import CacheManager
-from beaker.util import parse_cache_config_options
+import logging
+import os
+from os import environ
+from typing import Any, Dict, Iterable, List, Tuple
+import gevent
+import requests
+import caching
+import geo
+import history
 import importer
+import metrics
+import planner
+import poller
+import pubsub
 import ratt
+import singleflight
+import snapshot
 import velo
 
 cache_opts = {
-    'cache.type': 'file',
-    'cache.data_dir': 'cache/data',
-    'cache.lock_dir': 'cache/lock'
+    'cache.max_entries': environ.get('CACHE_MAX_ENTRIES', '1024'),
+    'cache.shared': environ.get('CACHE_SHARED', '')
 }
 
-cache = CacheManager(**parse_cache_config_options(cache_opts))
+cache = caching.from_config(cache_opts)
+
+logger = logging.getLogger(__name__)
 
 known_stations_csv = "Lines Stations and Junctions - Timisoara Public Transport - Denumiri-20152012.csv"
 known_lines_csv = "Timisoara Public Transport - Linii.csv"
+snapshot_file = environ.get('SNAPSHOT_FILE', 'snapshot.db')
+history_file = environ.get('HISTORY_FILE', 'history.db')
 
 
 @cache.cache('all_stations', expire=3600 * 24)
+@singleflight.coalesce
 def get_stations():
-	return { station.raw_name: station for station in importer.parse_stations_from_csv(known_stations_csv) }
+	return importer.import_stations(known_stations_csv).by_raw_name
 
 
 @cache.cache('all_lines', expire=3600 * 24)
+@singleflight.coalesce
 def get_lines():
-	return importer.parse_lines_from_csv(known_lines_csv)
+	return importer.import_lines(known_lines_csv).lines
+
+
+# whether this process scrapes upstream data; the other workers of a pre-forked server (see server.py) read what
+# the leader shares through the snapshot file and the shared cache tier
+leader = True
+
+
+def set_leader(is_leader: bool):
+	global leader
+	leader = is_leader
+	for data_poller in pollers:
+		data_poller.leader = is_leader
+
+
+routes_key = ('all_routes', ())
+routes_expire = 3600 * 24
+stale_routes_retry = 600
+# seconds the other processes keep their copy of the routes before checking for newer ones shared by the leader
+follower_routes_ttl = float(environ.get('FOLLOWER_ROUTES_TTL', '60'))
+
+
+# routes kept up to date from the line pages fetched for arrivals, see ratt.RouteDiscovery
+route_discovery = ratt.RouteDiscovery(known_lines_csv, known_stations_csv)
+# whether the routes were loaded from a stale snapshot and still have to be rediscovered by the leader
+routes_stale = False
+# (version, routes) last read by a process other than the leader from what the leader shared
+_shared_routes = (None, None)  # type: Tuple[Any, Dict[int, Tuple[ratt.Route, ratt.Route]]]
+
+
+def _save_routes(routes):
+	global routes_stale
+	cache.set(routes_key, routes, routes_expire)
+	if not leader:
+		# the master discovering before forking: its workers must still check for what their leader shares later
+		cache.set(routes_key, routes, follower_routes_ttl, shared=False)
+	routes_stale = False
+	if snapshot_file:
+		snapshot.save(snapshot_file, get_stations(), get_lines(), routes)
+
+
+def _routes_changed(routes):
+	if leader:
+		_save_routes(routes)
+
+
+route_discovery.listeners.append(_routes_changed)
+
+
+def _read_shared_routes():
+	"""
+	Read the routes the leader shared, from the shared cache tier or else the snapshot file, in a process other than
+	the leader. They are cached locally for `follower_routes_ttl` seconds only, so that the line changes the leader
+	finds reach every process quickly; the same routes object is kept while the leader shares nothing newer, so that
+	the indexes derived from it are not rebuilt.
+
+	Returns
+	-------
+	The routes, or None if the leader shared none yet
+	"""
+	global _shared_routes, routes_stale
+	version, routes = None, None
+	if cache.shared is not None:
+		routes, expires_at = cache.shared.get(repr(routes_key))
+		version = ('shared', expires_at)
+	if not isinstance(routes, dict):
+		if not snapshot_file or not os.path.exists(snapshot_file):
+			return None
+		version, routes = ('snapshot', os.stat(snapshot_file).st_mtime_ns), None
+
+	if version != _shared_routes[0]:
+		if routes is None:
+			loaded = snapshot.load(snapshot_file)
+			if loaded is None:
+				return None
+			routes = loaded.routes
+			# the process elected leader later rediscovers a stale snapshot, see server.py
+			routes_stale = loaded.age >= routes_expire
+		route_discovery.adopt(routes)
+		_shared_routes = (version, routes)
+
+	routes = _shared_routes[1]
+	cache.set(routes_key, routes, follower_routes_ttl, shared=False)
+	return routes
+
+
+def _discover_routes():
+	if not leader and route_discovery.routes:
+		# only the leader scrapes infotrafic; the others scrape only when they have no routes at all, like the master
+		# before forking without a snapshot
+		routes = route_discovery.routes
+		cache.set(routes_key, routes, follower_routes_ttl, shared=False)
+		return routes
+
+	# only the lines the arrivals poller did not fetch lately are crawled
+	routes = route_discovery.discover(max_age=routes_expire)
+	# an empty result means infotrafic is unavailable; don't let it replace a good network
+	if routes:
+		_save_routes(routes)
+	return routes
+
+
+def _discover_routes_quietly():
+	try:
+		_discover_routes()
+	except Exception:
+		logger.exception("event=route_discovery_failed")
+
+
+@singleflight.coalesce
+def _load_routes():
+	global routes_stale
+	if not leader:
+		routes = _read_shared_routes()
+		if routes:
+			return routes
+
+	loaded = snapshot.load(snapshot_file) if snapshot_file else None
+	if loaded is None:
+		routes = _discover_routes()
+		if not routes:
+			cache.set(routes_key, routes, stale_routes_retry)
+		return routes
+
+	route_discovery.seed(loaded.routes)
+	if loaded.age < routes_expire:
+		cache.set(routes_key, loaded.routes, routes_expire - loaded.age)
+	else:
+		# serve the stale snapshot while the network is rediscovered in the background, by the leader only
+		cache.set(routes_key, loaded.routes, stale_routes_retry)
+		routes_stale = True
+		if leader:
+			gevent.spawn(_discover_routes_quietly)
+
+	return loaded.routes
 
 
-@cache.cache('all_routes', expire=3600 * 24)
 def get_routes():
-	return ratt.get_route_info_from_infotraffic(known_lines_csv, known_stations_csv)
+	# the other processes do not copy the routes of the shared tier for their whole lifetime, see _read_shared_routes
+	routes = cache.get(routes_key, shared=leader, default=None)
+	return routes if routes is not None else _load_routes()
 
 
-@cache.cache('line_arrivals', expire=30)
-def get_arrivals(line_id: int):
-	return ratt.get_arrivals_from_infotrafic(line_id, get_stations())
+arrivals_fallbacks_total = metrics.counter('arrivals_fallbacks_total',
+                                           "Line arrivals fetched station by station because infotrafic failed.")
 
 
-@cache.cache('bike_stations', expire=90)
-def get_bike_stations():
+@singleflight.coalesce
+def _fetch_arrivals(line_id: int):
+	try:
+		return ratt.get_arrivals_from_infotrafic(line_id, get_stations(), route_discovery)
+	except requests.RequestException as e:
+		# the routes known so far; discovering them would need infotrafic
+		routes = route_discovery.routes
+		if line_id not in routes:
+			raise
+		logger.warning("event=arrivals_fallback line_id=%d error=%r", line_id, str(e))
+		arrivals_fallbacks_total.inc()
+		return ratt.get_arrivals_from_station_times(line_id, routes[line_id])
+
+
+arrivals_poller = poller.Poller('line_arrivals', _fetch_arrivals, lambda: [line.line_id for line in get_lines()],
+                                interval=float(environ.get('ARRIVALS_POLL_INTERVAL', '30')),
+                                concurrency=int(environ.get('ARRIVALS_POLL_CONCURRENCY', '4')),
+                                retry_after=float(environ.get('UPSTREAM_RETRY_AFTER', '10')), shared=cache.shared,
+                                cold_interval=float(environ.get('ARRIVALS_POLL_COLD_INTERVAL', '300')),
+                                half_life=float(environ.get('POLL_DEMAND_HALF_LIFE', '600')))
+
+
+def get_arrivals_snapshot(line_id: int) -> poller.Snapshot:
+	return arrivals_poller.get(line_id)
+
+
+def get_arrivals_snapshots(line_ids: Iterable[int]) -> Dict[int, poller.Snapshot]:
+	return arrivals_poller.get_many(line_ids)
+
+
+# arrivals of every fetched line, and the inter-station travel times learned from them; recorded by the leader only
+arrival_history = history.ArrivalHistory(history_file, retention=float(environ.get('HISTORY_RETENTION_DAYS', '3')) * 24 * 3600) \
+	if history_file else None
+_predicted = {}  # type: Dict[int, Tuple[poller.Snapshot, Tuple[List[ratt.Arrival], ...]]]
+
+
+def _record_arrivals(line_id: int, snapshot: poller.Snapshot):
+	if not leader or arrival_history is None:
+		return
+	hour = ratt.local_now().hour
+	for route_id, arrivals in enumerate(snapshot.value):
+		arrival_history.record(line_id, route_id, arrivals, snapshot.fetched_at, hour)
+
+
+def get_predicted_arrivals(line_id: int, snapshot: poller.Snapshot) -> Tuple[List[ratt.Arrival], ...]:
+	"""
+	Arrivals of both routes of a line in `snapshot`, with the timetable arrivals replaced by predictions where the
+	travel times from a vehicle estimated in real time are known. Predicted once per snapshot.
+	"""
+	if arrival_history is None:
+		return snapshot.value
+
+	predicted = _predicted.get(line_id, None)
+	if predicted is None or predicted[0] is not snapshot:
+		hour = ratt.local_now().hour
+		predicted = _predicted[line_id] = (snapshot, tuple(arrival_history.predict(line_id, route_id, arrivals, hour)
+		                                                   for route_id, arrivals in enumerate(snapshot.value)))
+	return predicted[1]
+
+
+@singleflight.coalesce
+def _fetch_bike_stations(key):
 	return velo.get_stations_from_velo()
 
+
+bike_stations_poller = poller.Poller('bike_stations', _fetch_bike_stations, lambda: ['all'],
+                                     interval=float(environ.get('BIKE_STATIONS_POLL_INTERVAL', '90')), concurrency=1,
+                                     retry_after=float(environ.get('UPSTREAM_RETRY_AFTER', '10')), shared=cache.shared,
+                                     cold_interval=float(environ.get('BIKE_STATIONS_POLL_COLD_INTERVAL', '600')),
+                                     half_life=float(environ.get('POLL_DEMAND_HALF_LIFE', '600')))
+
+
+def get_bike_stations():
+	return bike_stations_poller.get('all').value
+
+
+def bike_stations_stale() -> bool:
+	return bike_stations_poller.is_stale('all')
+
+
+# live updates: every poller refresh publishes what changed to the subscribers of the refreshed line or bike stations
+hub = pubsub.Hub()
+diff_publisher = pubsub.DiffPublisher(hub)
+
+
+def arrivals_topic(line_id: int, route_id: int) -> str:
+	return "arrivals:%d:%d" % (line_id, route_id)
+
+
+bike_stations_topic = "bike_stations"
+
+
+def _publish_arrivals(line_id: int, snapshot: poller.Snapshot):
+	for route_id, arrivals in enumerate(get_predicted_arrivals(line_id, snapshot)):
+		diff_publisher.update(arrivals_topic(line_id, route_id),
+		                      {arrival.station_id: (arrival.minutes_left, arrival.to_json()) for arrival in arrivals})
+
+
+def _publish_bike_stations(key: str, snapshot: poller.Snapshot):
+	diff_publisher.update(bike_stations_topic, {station.station_id: ((station.empty_spots, station.is_online), station.to_json())
+	                                            for station in snapshot.value})
+
+
+arrivals_poller.listeners.append(_record_arrivals)
+arrivals_poller.listeners.append(_publish_arrivals)
+bike_stations_poller.listeners.append(_publish_bike_stations)
+
+pollers = [arrivals_poller, bike_stations_poller]
+
+metrics.counter('cache_hits_total', "Cache lookups that found a value, by cached function.", ['function'],
+                lambda: [((namespace,), stats['hits']) for namespace, stats in cache.namespace_stats.items()] +
+                        [((data_poller.name,), data_poller.hits) for data_poller in pollers])
+metrics.counter('cache_misses_total', "Cache lookups that had to compute the value, by cached function.", ['function'],
+                lambda: [((namespace,), stats['misses']) for namespace, stats in cache.namespace_stats.items()] +
+                        [((data_poller.name,), data_poller.misses) for data_poller in pollers])
+metrics.counter('poller_errors_total', "Failed refreshes of polled data.", ['poller'],
+                lambda: [((data_poller.name,), sum(data_poller.errors.values())) for data_poller in pollers])
+metrics.gauge('poller_snapshots', "Keys with polled data.", ['poller'],
+              lambda: [((data_poller.name,), len(data_poller.snapshots)) for data_poller in pollers])
+metrics.gauge('poller_demand', "Decayed request count of each polled key.", ['poller', 'key'],
+              lambda: [((data_poller.name, key), data_poller.demand.score(key)) for data_poller in pollers
+                       for key in list(data_poller.demand.scores) if data_poller.is_known(key)])
+metrics.gauge('subscriptions', "Open push subscriptions.", [],
+              lambda: [((), len(set().union(*hub.subscriptions.values())))])
+
+
+@caching.derived(get_lines)
+def get_line_ids(lines):
+	return frozenset(line.line_id for line in lines)
+
+
+@caching.derived(get_lines)
+def get_line_types(lines):
+	return frozenset(line.line_type for line in lines)
+
+
+@caching.derived(get_stations)
+def get_stations_index(stations):
+	return geo.SpatialIndex(stations.values())
+
+
+@caching.derived(get_bike_stations)
+def get_bike_stations_index(bike_stations):
+	return geo.SpatialIndex(bike_stations)
+
+
+@caching.derived(get_routes)
+def get_station_routes_index(routes):
+	return ratt.StationRoutesIndex(routes)
+
+
+@caching.derived(get_routes)
+def get_transit_graph(routes):
+	return planner.TransitGraph(routes)
+
+
+@caching.derived(get_transit_graph)
+def get_transfer_table(graph):
+	bike_stations = bike_stations_poller.peek('all')
+	return planner.TransferTable(graph, bike_stations.value if bike_stations is not None else ())
+
+
+def _update_transfer_table(key: str, snapshot: poller.Snapshot):
+	# only once the network is known; the table is built with the current bike stations when it is first needed
+	if cache.get(routes_key, default=None) is not None:
+		get_transfer_table().update_bike_stations(snapshot.value)
+
+
+bike_stations_poller.listeners.append(_update_transfer_table)
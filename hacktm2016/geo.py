@@ -0,0 +1,153 @@
+import heapq
+import math
+from typing import Callable, Dict, Iterable, List, Tuple, TypeVar
+
+T = TypeVar('T')
+
+EARTH_RADIUS = 6371008.8  # mean earth radius, in meters
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def check_coordinates(lat: float, lng: float):
+	"""
+	Raise ValueError unless `lat` and `lng` are finite and within [-90, 90] and [-180, 180] degrees.
+	"""
+	if not (math.isfinite(lat) and math.isfinite(lng)):
+		raise ValueError("coordinates must be finite numbers")
+	if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+		raise ValueError("coordinates out of range: %r, %r" % (lat, lng))
+
+
+def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+	"""
+	Great-circle distance in meters between two points given in decimal degrees.
+	"""
+	lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+	a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+	return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex:
+	"""
+	Uniform grid over objects with `lat` and `lng` attributes, answering nearest-neighbour and radius queries
+	with haversine distances.
+
+	The grid is built once; queries only look at the cells around the query point instead of the whole data set.
+	"""
+
+	def __init__(self, items: Iterable[T], cell_size: float = 500):
+		"""
+		Parameters
+		----------
+		items objects to index; objects with missing coordinates are skipped
+		cell_size approximate edge length of a grid cell, in meters
+		"""
+		self.items = [item for item in items if item.lat is not None and item.lng is not None]  # type: List[T]
+		self.cells = {}  # type: Dict[Tuple[int, int], List[T]]
+
+		if self.items:
+			max_abs_lat = max(abs(item.lat) for item in self.items)
+			mean_lat = sum(item.lat for item in self.items) / len(self.items)
+		else:
+			max_abs_lat = mean_lat = 0.0
+
+		self.cell_lat = cell_size / METERS_PER_DEGREE
+		self.cell_lng = cell_size / (METERS_PER_DEGREE * max(math.cos(math.radians(mean_lat)), 0.01))
+		# lower bound for the size of a cell, used to decide when a nearest-neighbour search can stop
+		self.min_cell_meters = min(self.cell_lat * METERS_PER_DEGREE,
+		                           self.cell_lng * METERS_PER_DEGREE * math.cos(math.radians(min(max_abs_lat, 89.0))))
+
+		for item in self.items:
+			self.cells.setdefault(self._cell(item.lat, item.lng), []).append(item)
+
+		if self.cells:
+			rows = [row for row, col in self.cells]
+			cols = [col for row, col in self.cells]
+			self.bounds = (min(rows), max(rows), min(cols), max(cols))
+		else:
+			self.bounds = (0, 0, 0, 0)
+
+	def __len__(self):
+		return len(self.items)
+
+	def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+		return int(math.floor(lat / self.cell_lat)), int(math.floor(lng / self.cell_lng))
+
+	def _ring(self, row: int, col: int, radius: int) -> Iterable[T]:
+		if radius == 0:
+			yield from self.cells.get((row, col), ())
+			return
+
+		for r in range(row - radius, row + radius + 1):
+			step = 1 if r in (row - radius, row + radius) else 2 * radius
+			for c in range(col - radius, col + radius + 1, step):
+				yield from self.cells.get((r, c), ())
+
+	def _clamp(self, row: int, col: int) -> Tuple[int, int]:
+		"""
+		The cell within `bounds` closest to the given one.
+		"""
+		min_row, max_row, min_col, max_col = self.bounds
+		return min(max(row, min_row), max_row), min(max(col, min_col), max_col)
+
+	def _max_ring(self, row: int, col: int) -> int:
+		min_row, max_row, min_col, max_col = self.bounds
+		return max(abs(row - min_row), abs(row - max_row), abs(col - min_col), abs(col - max_col))
+
+	def nearest(self, lat: float, lng: float, count: int = 1, predicate: Callable[[T], bool] = None) -> List[Tuple[float, T]]:
+		"""
+		Find the `count` objects closest to the given point, optionally only among objects matching `predicate`.
+
+		Returns
+		-------
+		List of (distance in meters, object) tuples, closest first
+		"""
+		if count <= 0 or not self.items:
+			return []
+
+		# rings around the closest cell of the grid cover the grid in as many steps as the grid is wide, however far
+		# the point is; an object in a ring further out from that cell is also further out from the point's own cell
+		row, col = self._clamp(*self._cell(lat, lng))
+		heap = []  # max-heap of the best candidates found so far, as (-distance, tie breaker, object)
+		for radius in range(self._max_ring(row, col) + 1):
+			for item in self._ring(row, col, radius):
+				if predicate is not None and not predicate(item):
+					continue
+				entry = (-haversine(lat, lng, item.lat, item.lng), id(item), item)
+				if len(heap) < count:
+					heapq.heappush(heap, entry)
+				elif entry > heap[0]:
+					heapq.heapreplace(heap, entry)
+
+			# every object in a ring further out is at least `radius` whole cells away
+			if len(heap) == count and -heap[0][0] <= radius * self.min_cell_meters:
+				break
+
+		return [(-distance, item) for distance, _, item in sorted(heap, reverse=True)]
+
+	def within(self, lat: float, lng: float, radius: float) -> List[Tuple[float, T]]:
+		"""
+		Find all objects within `radius` meters of the given point.
+
+		Returns
+		-------
+		List of (distance in meters, object) tuples, closest first
+		"""
+		if radius < 0 or not self.items:
+			return []
+
+		dlat = radius / METERS_PER_DEGREE
+		dlng = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + dlat, 89.0))), 0.01))
+		min_row, min_col = self._cell(lat - dlat, lng - dlng)
+		max_row, max_col = self._cell(lat + dlat, lng + dlng)
+
+		result = []
+		for r in range(max(min_row, self.bounds[0]), min(max_row, self.bounds[1]) + 1):
+			for c in range(max(min_col, self.bounds[2]), min(max_col, self.bounds[3]) + 1):
+				for item in self.cells.get((r, c), ()):
+					distance = haversine(lat, lng, item.lat, item.lng)
+					if distance <= radius:
+						result.append((distance, item))
+
+		result.sort(key=lambda entry: entry[0])
+		return result
@@ -0,0 +1,196 @@
+"""
+Arrival history: an append-only record of the arrivals fetched from infotrafic, and the travel times between
+successive stations learned from it, used to predict the arrivals that infotrafic only knows from the timetable.
+"""
+
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import ratt
+
+logger = logging.getLogger(__name__)
+
+# hops between two successive stations longer than this are not learned, since the estimates of the two stations
+# are then most likely for different vehicles
+max_hop_minutes = 15
+
+
+class ArrivalHistory:
+	"""
+	Arrivals stored in a sqlite database file, one row per (line, route, station) whenever the expected arrival
+	changes, along with the mean travel time from each station to the next one of its route, by hour of the day.
+
+	Parameters
+	----------
+	filename sqlite database file, created if missing once the history is first used
+	retention seconds after which recorded arrivals are deleted
+	max_samples number of samples the mean travel times are averaged over; older samples weigh less and less
+	reload_interval seconds between reloads of the travel times written by other processes
+	"""
+
+	def __init__(self, filename: str, retention: float = 3 * 24 * 3600, max_samples: int = 50,
+	             reload_interval: float = 600):
+		self.filename = filename
+		self.retention = retention
+		self.max_samples = max_samples
+		self.reload_interval = reload_interval
+		# [samples, mean minutes] of the hop from a station to the next one, by (line_id, route_id, station_id, hour)
+		self.travel = {}  # type: Dict[Tuple[int, int, int, int], List[float]]
+		# last expected arrival minute recorded, by (line_id, route_id, station_id)
+		self.last_recorded = {}  # type: Dict[Tuple[int, int, int], Tuple[int, bool]]
+		self.loaded_at = 0.0
+		self.pruned_at = 0.0
+		self.recorded = self.skipped = self.predicted = 0
+		self._connection = None  # type: sqlite3.Connection
+
+	def reconnect(self):
+		"""
+		Drop the connection to the database, so that the next use opens a new one; must be called in a forked child
+		before using the history.
+		"""
+		self._connection = None
+
+	@property
+	def _db(self) -> sqlite3.Connection:
+		# the database is only opened (and created) once the history is actually used
+		if self._connection is None:
+			self._connection = self._connect()
+			self.load()
+		return self._connection
+
+	def _connect(self) -> sqlite3.Connection:
+		db = sqlite3.connect(self.filename, timeout=10, isolation_level=None, check_same_thread=False)
+		db.execute("PRAGMA journal_mode=WAL")
+		db.executescript("""
+			CREATE TABLE IF NOT EXISTS arrivals (line_id INTEGER, route_id INTEGER, station_id INTEGER,
+			                                     observed_at INTEGER, expected_at INTEGER, is_real_time INTEGER,
+			                                     PRIMARY KEY (line_id, route_id, station_id, observed_at)) WITHOUT ROWID;
+			CREATE TABLE IF NOT EXISTS travel_times (line_id INTEGER, route_id INTEGER, station_id INTEGER,
+			                                         hour INTEGER, samples INTEGER, minutes REAL,
+			                                         PRIMARY KEY (line_id, route_id, station_id, hour)) WITHOUT ROWID;
+		""")
+		return db
+
+	def load(self):
+		self.travel = {(line_id, route_id, station_id, hour): [samples, minutes]
+		               for line_id, route_id, station_id, hour, samples, minutes
+		               in self._db.execute("SELECT * FROM travel_times")}
+		self.loaded_at = time.time()
+
+	def record(self, line_id: int, route_id: int, arrivals: Sequence[ratt.Arrival], observed_at: float, hour: int):
+		"""
+		Append the arrivals of a route fetched at `observed_at` (a unix time, `hour` of the day in local time), and
+		learn the travel times between the successive stations with real time estimates.
+		"""
+		db = self._db  # opened first, so that the travel times learned below start from the stored ones
+		minute = int(observed_at // 60)
+		rows = []
+		for arrival in arrivals:
+			if arrival.minutes_left < 0:
+				continue
+			# the expected arrival of a vehicle stays put from one fetch to the next, while minutes_left counts down
+			expected = (minute + arrival.minutes_left, arrival.is_real_time)
+			key = (line_id, route_id, arrival.station_id)
+			if self.last_recorded.get(key, None) == expected:
+				self.skipped += 1
+				continue
+			self.last_recorded[key] = expected
+			rows.append(key + (minute, expected[0], int(expected[1])))
+
+		learned = []
+		for previous, following in zip(arrivals, arrivals[1:]):
+			if not (previous.is_real_time and following.is_real_time and previous.minutes_left >= 0):
+				continue
+			hop = following.minutes_left - previous.minutes_left
+			if 0 <= hop <= max_hop_minutes:
+				learned.append(self._learn((line_id, route_id, previous.station_id, hour), hop))
+
+		with db:
+			db.executemany("INSERT OR REPLACE INTO arrivals VALUES (?, ?, ?, ?, ?, ?)", rows)
+			db.executemany("INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?, ?, ?)", learned)
+		self.recorded += len(rows)
+
+		if observed_at - self.pruned_at > 3600:
+			self.prune(observed_at)
+
+	def _learn(self, key: Tuple[int, int, int, int], minutes: float) -> Tuple:
+		samples, mean = self.travel.setdefault(key, [0, 0.0])
+		samples = min(samples + 1, self.max_samples)
+		mean += (minutes - mean) / samples
+		self.travel[key] = [samples, mean]
+		return key + (samples, mean)
+
+	def prune(self, now: float = None):
+		now = time.time() if now is None else now
+		self.pruned_at = now
+		deleted = self._db.execute("DELETE FROM arrivals WHERE observed_at < ?", ((now - self.retention) // 60,)).rowcount
+		logger.info("event=history_pruned deleted=%d", deleted)
+
+	def travel_minutes(self, line_id: int, route_id: int, station_id: int, hour: int) -> Optional[float]:
+		"""
+		Mean travel time from `station_id` to the next station of the route around `hour`, or None if never observed.
+		"""
+		for nearby_hour in (hour, (hour - 1) % 24, (hour + 1) % 24):
+			learned = self.travel.get((line_id, route_id, station_id, nearby_hour), None)
+			if learned is not None:
+				return learned[1]
+		return None
+
+	def observations(self, line_id: int, route_id: int, station_id: int, since: float,
+	                 until: float = None) -> List[Tuple[int, int, bool]]:
+		"""
+		Arrivals recorded for a station of a route between two unix times.
+
+		Returns
+		-------
+		(observed at, expected at, is real time) of every recorded arrival, with both times in unix minutes
+		"""
+		until = time.time() if until is None else until
+		return [(observed_at, expected_at, bool(is_real_time)) for observed_at, expected_at, is_real_time in self._db.execute(
+			"SELECT observed_at, expected_at, is_real_time FROM arrivals "
+			"WHERE line_id = ? AND route_id = ? AND station_id = ? AND observed_at BETWEEN ? AND ? ORDER BY observed_at",
+			(line_id, route_id, station_id, since // 60, until // 60))]
+
+	def predict(self, line_id: int, route_id: int, arrivals: Sequence[ratt.Arrival], hour: int) -> List[ratt.Arrival]:
+		"""
+		Replace the timetable arrivals of a route by the arrival of the closest vehicle estimated in real time at a
+		previous station, plus the travel times learned between that station and this one.
+
+		Parameters
+		----------
+		arrivals arrivals of the route, in the order of its stations
+		hour local hour of the day the arrivals are for
+
+		Returns
+		-------
+		The arrivals, with the predicted ones marked with `is_predicted`
+		"""
+		if time.time() - self.loaded_at > self.reload_interval:
+			self.load()
+
+		result = []
+		expected = None  # minutes until the closest vehicle before the current station arrives there
+		previous = None  # type: ratt.Arrival
+		for arrival in arrivals:
+			if expected is not None:
+				hop = self.travel_minutes(line_id, route_id, previous.station_id, hour)
+				expected = expected + hop if hop is not None else None
+
+			if arrival.is_real_time and arrival.minutes_left >= 0:
+				expected = arrival.minutes_left
+			elif expected is not None:
+				minutes_left = int(round(expected))
+				arrival = ratt.Arrival(line_id, arrival.station_id, "%d min." % minutes_left, minutes_left, False,
+				                       is_predicted=True)
+				self.predicted += 1
+
+			result.append(arrival)
+			previous = arrival
+
+		return result
+
+	def stats(self) -> Dict[str, Any]:
+		return {'filename': self.filename, 'recorded': self.recorded, 'skipped': self.skipped,
+		        'predicted': self.predicted, 'travel_times': len(self.travel)}
@@ -1,41 +1,208 @@
 import ratt
+import collections
 import csv
+import logging
+import os
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
+import geo
+import metrics
 
-def parse_stations_from_csv(filename: str):
-	with open(filename, newline='') as csvfile:
-		result = set()
+logger = logging.getLogger(__name__)
+
+station_field_names = ['LineID', 'LineName', 'StationID', 'RawStationName', 'FriendlyStationName',
+                       'ShortStationName', 'JunctionName', 'Lat', 'Long', 'Invalid', 'Verified',
+                       'VerificationDate', 'GoogleMapsID', 'InfoComments']
+
+
+class RowProblem:
+	"""
+	A row of a csv file that does not fit its schema; `reason` is one of a few fixed values, such as
+	'invalid_station_id' or 'missing_coordinates'.
+	"""
+
+	def __init__(self, line_number: int, row: Dict[str, str], reason: str):
+		self.line_number = line_number
+		self.row = row
+		self.reason = reason
+
+	def __repr__(self):
+		return "RowProblem(line_number=%r, row=%r, reason=%r)" % (self.line_number, self.row, self.reason)
+
+	def to_json(self) -> Dict[str, Any]:
+		return {'line_number': self.line_number, 'row': self.row, 'reason': self.reason}
+
+
+class StationsImport:
+	"""
+	Stations read from a stations csv file, with lookups by raw name, station ID and junction name.
+	"""
+
+	def __init__(self):
+		self.stations = []  # type: List[ratt.Station]
+		self.by_raw_name = {}  # type: Dict[str, ratt.Station]
+		self.by_station_id = {}  # type: Dict[int, List[ratt.Station]]
+		self.by_junction = {}  # type: Dict[str, List[ratt.Station]]
+		self.problems = []  # type: List[RowProblem]
+
+	def add(self, station: 'ratt.Station'):
+		if station.raw_name in self.by_raw_name:
+			return
+
+		self.stations.append(station)
+		self.by_raw_name[station.raw_name] = station
+		self.by_station_id.setdefault(station.station_id, []).append(station)
+		if station.junction_name:
+			self.by_junction.setdefault(station.junction_name, []).append(station)
 
-		field_names = ['LineID', 'LineName', 'StationID', 'RawStationName', 'FriendlyStationName',
-		               'ShortStationName', 'JunctionName', 'Lat', 'Long', 'Invalid', 'Verified',
-		               'VerificationDate', 'GoogleMapsID', 'InfoComments']
 
+class LinesImport:
+	"""
+	Lines read from a lines csv file, with a lookup by line ID.
+	"""
+
+	def __init__(self):
+		self.lines = []  # type: List[ratt.Line]
+		self.by_line_id = {}  # type: Dict[int, ratt.Line]
+		self.problems = []  # type: List[RowProblem]
+
+	def add(self, line: 'ratt.Line'):
+		self.lines.append(line)
+		self.by_line_id[line.line_id] = line
+
+
+_imports = {}  # type: Dict[Tuple[str, str], Tuple[Tuple[int, int], Any]]
+
+
+def _memoized(kind: str, filename: str, parse: Callable[[str], Any]) -> Any:
+	"""
+	Call `parse(filename)` only if the file changed since the last call, according to its modification time and size.
+	"""
+	stat = os.stat(filename)
+	version = (stat.st_mtime_ns, stat.st_size)
+	memo = _imports.get((kind, filename), None)
+	if memo is None or memo[0] != version:
+		memo = _imports[(kind, filename)] = (version, parse(filename))
+
+	return memo[1]
+
+
+def _read_rows(filename: str, field_names: List[str] = None) -> Iterator[Tuple[int, Dict[str, str]]]:
+	with open(filename, newline='') as csvfile:
 		filereader = csv.DictReader(csvfile, field_names, delimiter=',', quotechar='"')
 		for row in filereader:
+			yield filereader.line_num, row
+
+
+def _parse_station_rows(rows: Iterable[Tuple[int, Dict[str, str]]]) -> Iterator[Union['ratt.Station', RowProblem]]:
+	"""
+	Stations of the rows of a stations csv file, along with the problems of the rows; rows marked invalid and the
+	title, header and blank rows repeated through the file are skipped silently.
+	"""
+	defined = {}  # type: Dict[str, Tuple[int, ratt.Station]]
+	for line_number, row in rows:
+		if row['Invalid'] == 'TRUE' or row['StationID'] == 'StationID' or not (row['StationID'] or row['RawStationName']):
+			continue
+
+		try:
+			station_id = int(row['StationID'])
+		except (TypeError, ValueError):
+			yield RowProblem(line_number, row, 'invalid_station_id')
+			continue
+
+		if not row['Lat'] and not row['Long']:
+			lat, lng = None, None
+			yield RowProblem(line_number, row, 'missing_coordinates')
+		else:
 			try:
-				if row['Invalid'] != 'TRUE':
-					try:
-						lat, lng = float(row['Lat']), float(row['Long'])
-					except ValueError:
-						lat, lng = None, None
-					station = ratt.Station(int(row['StationID']), row['RawStationName'], row['ShortStationName'],
-					                       row['JunctionName'], lat, lng, row['GoogleMapsID'])
+				lat, lng = float(row['Lat']), float(row['Long'])
+				geo.check_coordinates(lat, lng)
+			except (TypeError, ValueError):
+				lat, lng = None, None
+				yield RowProblem(line_number, row, 'invalid_coordinates')
 
-					result.add(station)
-			except ValueError:
-				continue
+		station = ratt.Station(station_id, row['RawStationName'], row['ShortStationName'], row['JunctionName'], lat, lng,
+		                       row['GoogleMapsID'])
+		first = defined.setdefault(station.raw_name, (line_number, station))[1]
+		# the same station is listed once per line serving it; only the first definition of a raw name is kept
+		if (first.station_id, first.lat, first.lng) != (station.station_id, station.lat, station.lng):
+			yield RowProblem(line_number, row, 'conflicting_duplicate')
+			continue
 
-	return list(result)
+		yield station
 
 
-def parse_lines_from_csv(filename: str):
-	with open(filename, newline='') as csvfile:
-		result = []
-		filereader = csv.DictReader(csvfile, delimiter=',', quotechar ='"')
+def _parse_line_rows(rows: Iterable[Tuple[int, Dict[str, str]]]) -> Iterator[Union['ratt.Line', RowProblem]]:
+	for line_number, row in rows:
+		if not (row['LineID'] or row['LineName']):
+			continue
 
-		for row in filereader:
-			line = ratt.Line(int(row['LineID']), row['LineName'], row['FriendlyName'], row['LineType'], row['RouteName1'], row['RouteName2'])
-			result.append(line)
+		try:
+			line_id = int(row['LineID'])
+		except (TypeError, ValueError):
+			yield RowProblem(line_number, row, 'invalid_line_id')
+			continue
+
+		yield ratt.Line(line_id, row['LineName'], row['FriendlyName'], row['LineType'], row['RouteName1'], row['RouteName2'])
+
+
+def _report_problems(filename: str, problems: List[RowProblem]):
+	for problem in problems:
+		logger.debug("event=csv_row_problem file=%r line_number=%d reason=%s row=%r",
+		             filename, problem.line_number, problem.reason, problem.row)
+	if problems:
+		counts = collections.Counter(problem.reason for problem in problems)
+		logger.warning("event=csv_row_problems file=%r problems=%d %s", filename, len(problems),
+		               " ".join("%s=%d" % (reason, count) for reason, count in sorted(counts.items())))
+
+
+def _import_stations(filename: str) -> StationsImport:
+	result = StationsImport()
+	for item in _parse_station_rows(_read_rows(filename, station_field_names)):
+		if isinstance(item, RowProblem):
+			result.problems.append(item)
+		else:
+			result.add(item)
+
+	_report_problems(filename, result.problems)
+	return result
+
+
+def _import_lines(filename: str) -> LinesImport:
+	result = LinesImport()
+	for item in _parse_line_rows(_read_rows(filename)):
+		if isinstance(item, RowProblem):
+			result.problems.append(item)
+		else:
+			result.add(item)
+
+	_report_problems(filename, result.problems)
+	return result
+
+
+def import_stations(filename: str) -> StationsImport:
+	"""
+	Read the stations of a stations csv file; the file is only parsed again after it changes.
+	"""
+	return _memoized('stations', filename, _import_stations)
+
+
+def import_lines(filename: str) -> LinesImport:
+	"""
+	Read the lines of a lines csv file; the file is only parsed again after it changes.
+	"""
+	return _memoized('lines', filename, _import_lines)
+
+
+def parse_stations_from_csv(filename: str):
+	return list(import_stations(filename).stations)
+
+
+def parse_lines_from_csv(filename: str):
+	return list(import_lines(filename).lines)
 
-		return result
 
+metrics.gauge('csv_row_problems', "Rows of the imported csv files that do not fit their schema, by file and reason.",
+              ['file', 'reason'],
+              lambda: [((os.path.basename(filename), reason), count) for (kind, filename), (version, result) in _imports.items()
+                       for reason, count in collections.Counter(problem.reason for problem in result.problems).items()])
@@ -4,14 +4,15 @@ The flask application package.
 
 import flask
 from flask import Flask
-import gevent
-import grequests
+import gevent.monkey
+import metrics
 patched = False
 if not patched:
     gevent.monkey.patch_all()
     patched = True
 
 app = Flask(__name__)
+metrics.instrument(app)
 
 
 @app.after_request
@@ -0,0 +1,214 @@
+"""
+Minimal Prometheus-style metrics: counters, gauges and histograms with labels, rendered in the Prometheus text
+exposition format.
+"""
+
+import bisect
+import time
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+import flask
+
+# upper bounds of the default latency histogram buckets, in seconds
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Iterable[Tuple[str, str]] = ()) -> str:
+	pairs = list(zip(names, values)) + list(extra)
+	if not pairs:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+	                         for name, value in pairs)
+
+
+def _format_value(value: float) -> str:
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+	kind = 'untyped'
+
+	def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+		self.name = name
+		self.documentation = documentation
+		self.label_names = tuple(labels)
+		self.children = {}  # type: Dict[Tuple[str, ...], Any]
+
+	def labels(self, *values, **kwargs):
+		if kwargs:
+			values = tuple(kwargs[name] for name in self.label_names)
+		key = tuple(str(value) for value in values)
+		child = self.children.get(key, None)
+		if child is None:
+			child = self.children[key] = self._new_child()
+		return child
+
+	def _new_child(self):
+		raise NotImplementedError
+
+	def samples(self) -> Iterable[str]:
+		raise NotImplementedError
+
+	def render(self) -> List[str]:
+		lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+		lines.extend(self.samples())
+		return lines
+
+
+class _Value:
+	def __init__(self):
+		self.value = 0.0
+
+	def inc(self, amount: float = 1):
+		self.value += amount
+
+	def set(self, value: float):
+		self.value = value
+
+
+class _SimpleMetric(Metric):
+	"""
+	Metric with a single value per label set; values are either updated explicitly or read from `collect()` at
+	render time, as (label values, value) pairs.
+	"""
+
+	def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+	             collect: Callable[[], Iterable[Tuple[Sequence[str], float]]] = None):
+		super().__init__(name, documentation, labels)
+		self.collect = collect
+
+	def _new_child(self):
+		return _Value()
+
+	def samples(self) -> Iterable[str]:
+		values = [(key, child.value) for key, child in self.children.items()]
+		if self.collect is not None:
+			values.extend(self.collect())
+		for key, value in values:
+			yield "%s%s %s" % (self.name, _format_labels(self.label_names, key), _format_value(value))
+
+
+class Counter(_SimpleMetric):
+	kind = 'counter'
+
+	def inc(self, amount: float = 1):
+		self.labels().inc(amount)
+
+
+class Gauge(_SimpleMetric):
+	kind = 'gauge'
+
+	def set(self, value: float):
+		self.labels().set(value)
+
+
+class _HistogramValue:
+	def __init__(self, buckets: Sequence[float]):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value: float):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def time(self):
+		return _Timer(self)
+
+	def to_json(self) -> Dict[str, Any]:
+		labels = [str(bucket) for bucket in self.buckets] + ['+Inf']
+		return {'buckets': dict(zip(labels, self.counts)), 'sum': self.sum, 'count': self.count}
+
+
+class _Timer:
+	def __init__(self, histogram: _HistogramValue):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.started = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram(Metric):
+	kind = 'histogram'
+
+	def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = default_buckets):
+		super().__init__(name, documentation, labels)
+		self.buckets = tuple(buckets)
+
+	def _new_child(self):
+		return _HistogramValue(self.buckets)
+
+	def observe(self, value: float):
+		self.labels().observe(value)
+
+	def samples(self) -> Iterable[str]:
+		for key, child in self.children.items():
+			cumulative = 0
+			for bound, count in zip(list(self.buckets) + [float('inf')], child.counts):
+				cumulative += count
+				yield "%s_bucket%s %d" % (self.name, _format_labels(self.label_names, key, [('le', _format_value(bound))]), cumulative)
+			yield "%s_sum%s %s" % (self.name, _format_labels(self.label_names, key), _format_value(child.sum))
+			yield "%s_count%s %d" % (self.name, _format_labels(self.label_names, key), child.count)
+
+
+class Registry:
+	def __init__(self):
+		self.metrics = {}  # type: Dict[str, Metric]
+
+	def register(self, metric: Metric) -> Metric:
+		if metric.name in self.metrics:
+			raise ValueError("metric %s is already registered" % metric.name)
+		self.metrics[metric.name] = metric
+		return metric
+
+	def render(self) -> str:
+		lines = []
+		for metric in self.metrics.values():
+			lines.extend(metric.render())
+		return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labels: Sequence[str] = (),
+            collect: Callable[[], Iterable[Tuple[Sequence[str], float]]] = None) -> Counter:
+	return registry.register(Counter(name, documentation, labels, collect))
+
+
+def gauge(name: str, documentation: str, labels: Sequence[str] = (),
+          collect: Callable[[], Iterable[Tuple[Sequence[str], float]]] = None) -> Gauge:
+	return registry.register(Gauge(name, documentation, labels, collect))
+
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = default_buckets) -> Histogram:
+	return registry.register(Histogram(name, documentation, labels, buckets))
+
+
+request_latency = histogram('http_request_duration_seconds', "Latency of HTTP requests, by route.",
+                            ['method', 'route', 'status'])
+
+
+def instrument(app: flask.Flask):
+	"""
+	Record the latency of every request handled by `app`, labeled with the matched route rule.
+	"""
+	@app.before_request
+	def start_timer():
+		flask.g.request_started = time.perf_counter()
+
+	@app.after_request
+	def observe_latency(response: flask.Response):
+		started = getattr(flask.g, 'request_started', None)
+		if started is not None:
+			route = flask.request.url_rule.rule if flask.request.url_rule is not None else 'unmatched'
+			request_latency.labels(flask.request.method, route, response.status_code).observe(time.perf_counter() - started)
+		return response
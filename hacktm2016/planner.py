@@ -0,0 +1,325 @@
+import math
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import geo
+import ratt
+import velo
+
+INFINITY = math.inf
+
+walking_speed = 75.0  # meters per minute
+riding_speed = 300.0  # meters per minute, used when live arrivals give no travel time between two stops
+max_transfer_walk = 400.0  # maximum walking distance between stops for a transfer, in meters
+max_access_walk = 800.0  # maximum walking distance from the origin / to the destination, in meters
+default_headway = 12.0  # assumed minutes between two vehicles of a route
+max_rounds = 4  # maximum number of vehicles used in a journey
+
+
+class TransitGraph:
+	"""
+	Compact representation of the network for the journey planner: stops and patterns (the ordered stops of a
+	route) are numbered, and everything else refers to them by index.
+	"""
+
+	def __init__(self, routes: Dict[int, Tuple[ratt.Route, ratt.Route]]):
+		self.stations = []  # type: List[ratt.Station]
+		self.stop_index = {}  # type: Dict[int, int]
+		self.patterns = []  # type: List[Tuple[int, int]]
+		self.pattern_stops = []  # type: List[List[int]]
+		self.pattern_ride_minutes = []  # type: List[List[float]]
+		self.stop_patterns = []  # type: List[List[Tuple[int, int]]]
+
+		for line_routes in routes.values():
+			for route in line_routes:
+				stops = []
+				for station in route.stations:
+					stop = self.stop_index.get(station.station_id, None)
+					if stop is None:
+						stop = self.stop_index[station.station_id] = len(self.stations)
+						self.stations.append(station)
+						self.stop_patterns.append([])
+					if stop not in stops:
+						stops.append(stop)
+
+				if len(stops) < 2:
+					continue
+
+				pattern = len(self.patterns)
+				self.patterns.append((route.line_id, route.route_id))
+				self.pattern_stops.append(stops)
+				self.pattern_ride_minutes.append([self._ride_minutes(stops[i], stops[i + 1]) for i in range(len(stops) - 1)])
+				for position, stop in enumerate(stops):
+					self.stop_patterns[stop].append((pattern, position))
+
+		self.pattern_index = {key: pattern for pattern, key in enumerate(self.patterns)}
+		self.spatial_index = geo.SpatialIndex(self.stations)
+		self.footpaths = [self._footpaths(stop) for stop in range(len(self.stations))]  # type: List[List[Tuple[int, float]]]
+
+	def _distance(self, stop1: int, stop2: int) -> Optional[float]:
+		station1, station2 = self.stations[stop1], self.stations[stop2]
+		if None in (station1.lat, station1.lng, station2.lat, station2.lng):
+			return None
+		return geo.haversine(station1.lat, station1.lng, station2.lat, station2.lng)
+
+	def _ride_minutes(self, stop1: int, stop2: int) -> float:
+		distance = self._distance(stop1, stop2)
+		return max(1.0, distance / riding_speed) if distance is not None else 2.0
+
+	def _footpaths(self, stop: int) -> List[Tuple[int, float]]:
+		station = self.stations[stop]
+		footpaths = {}
+		if station.lat is not None and station.lng is not None:
+			for distance, other in self.spatial_index.within(station.lat, station.lng, max_transfer_walk):
+				other_stop = self.stop_index[other.station_id]
+				if other_stop != stop:
+					footpaths[other_stop] = max(1.0, distance / walking_speed)
+
+		# stations of the same junction are always within walking distance, even without coordinates
+		if station.junction_name:
+			for other_stop, other in enumerate(self.stations):
+				if other_stop != stop and other.junction_name == station.junction_name and other_stop not in footpaths:
+					distance = self._distance(stop, other_stop)
+					footpaths[other_stop] = max(1.0, distance / walking_speed) if distance is not None else 2.0
+
+		return sorted(footpaths.items())
+
+	def nearby_stops(self, lat: float, lng: float) -> List[Tuple[int, float]]:
+		"""
+		Stops within walking distance of a point, as (stop, walking minutes) tuples.
+		"""
+		return [(self.stop_index[station.station_id], distance / walking_speed)
+		        for distance, station in self.spatial_index.within(lat, lng, max_access_walk)]
+
+
+class TransferTable:
+	"""
+	Precomputed transfers from every stop of the network: the stops of other lines within `max_transfer_walk`, and
+	the `bike_count` nearest bike stations within `max_access_walk`, with their distances, so that looking up the
+	transfers of a stop is a dict access.
+
+	The links to bike stations depend only on where the bike stations are; they are rebuilt by
+	`update_bike_stations` only when a bike station appears, disappears or moves.
+	"""
+
+	def __init__(self, graph: TransitGraph, bike_stations: Sequence[velo.Station] = (), bike_count: int = 3):
+		self.graph = graph
+		self.bike_count = bike_count
+		stop_lines = [frozenset(graph.patterns[pattern][0] for pattern, position in patterns)
+		              for patterns in graph.stop_patterns]
+
+		# (distance, station, lines of the station not serving the stop) of the nearby stops, by station ID
+		self.stops = {}  # type: Dict[int, List[Tuple[float, ratt.Station, List[int]]]]
+		for stop, station in enumerate(graph.stations):
+			nearby = []
+			if station.lat is not None and station.lng is not None:
+				for distance, other in graph.spatial_index.within(station.lat, station.lng, max_transfer_walk):
+					other_lines = stop_lines[graph.stop_index[other.station_id]] - stop_lines[stop]
+					if other.station_id != station.station_id and other_lines:
+						nearby.append((distance, other, sorted(other_lines)))
+			self.stops[station.station_id] = nearby
+
+		self.bike_stations = {}  # type: Dict[int, velo.Station]
+		self.bike_locations = None  # type: frozenset
+		# (distance, bike station ID) of the nearest bike stations, by station ID
+		self.bikes = {}  # type: Dict[int, List[Tuple[float, int]]]
+		self.update_bike_stations(bike_stations)
+
+	def update_bike_stations(self, bike_stations: Sequence[velo.Station]):
+		"""
+		Take the current state of the bike stations, relinking the stops to them if their locations changed.
+		"""
+		self.bike_stations = {bike_station.station_id: bike_station for bike_station in bike_stations}
+		locations = frozenset((bike_station.station_id, bike_station.lat, bike_station.lng) for bike_station in bike_stations)
+		if locations == self.bike_locations:
+			return
+
+		index = geo.SpatialIndex(bike_stations)
+		bikes = {}
+		for station in self.graph.stations:
+			if station.lat is not None and station.lng is not None:
+				bikes[station.station_id] = [(distance, bike_station.station_id) for distance, bike_station
+				                             in index.nearest(station.lat, station.lng, self.bike_count)
+				                             if distance <= max_access_walk]
+		self.bikes = bikes
+		self.bike_locations = locations
+
+	def stop_transfers(self, station_id: int) -> List[Tuple[float, ratt.Station, List[int]]]:
+		return self.stops.get(station_id, [])
+
+	def bike_transfers(self, station_id: int) -> List[Tuple[float, velo.Station]]:
+		return [(distance, self.bike_stations[bike_station_id]) for distance, bike_station_id in self.bikes.get(station_id, [])
+		        if bike_station_id in self.bike_stations]
+
+
+class LiveDepartures:
+	"""
+	Minutes until the next departure of each pattern at each of its stops, derived from live arrivals; ride times
+	between consecutive stops are taken from the arrivals where they are consistent.
+	"""
+
+	def __init__(self, graph: TransitGraph, arrivals: Dict[Tuple[int, int], Sequence[ratt.Arrival]],
+	             delays: Dict[Tuple[int, int], float] = None):
+		"""
+		Parameters
+		----------
+		graph network the arrivals refer to
+		arrivals arrivals of each (line_id, route_id)
+		delays minutes elapsed since the arrivals of each (line_id, route_id) were fetched
+		"""
+		self.next_departure = []  # type: List[List[Optional[float]]]
+		self.ride_minutes = []  # type: List[List[float]]
+		for pattern, key in enumerate(graph.patterns):
+			by_station = {}
+			delay = delays.get(key, 0) if delays else 0
+			for arrival in arrivals.get(key, ()):
+				if arrival.minutes_left >= 0:
+					by_station.setdefault(arrival.station_id, (arrival.minutes_left - delay, arrival.is_real_time))
+
+			stops = graph.pattern_stops[pattern]
+			ride_minutes = list(graph.pattern_ride_minutes[pattern])
+			departures = [by_station.get(graph.stations[stop].station_id, (None, False)) for stop in stops]
+			for i in range(len(ride_minutes)):
+				(this, this_real), (following, following_real) = departures[i], departures[i + 1]
+				if this_real and following_real and 0 < following - this <= 4 * ride_minutes[i]:
+					ride_minutes[i] = following - this
+
+			next_departure = []
+			for i, (minutes, real_time) in enumerate(departures):
+				if minutes is None and i > 0 and next_departure[i - 1] is not None:
+					minutes = next_departure[i - 1] + ride_minutes[i - 1]
+				next_departure.append(minutes)
+
+			self.next_departure.append(next_departure)
+			self.ride_minutes.append(ride_minutes)
+
+	def departure(self, pattern: int, position: int, time: float) -> float:
+		"""
+		Earliest departure of a pattern from the stop at `position` for a passenger reaching the stop at `time`.
+		"""
+		minutes = self.next_departure[pattern][position]
+		if minutes is None:
+			return time + default_headway / 2
+		if minutes < time:
+			minutes += math.ceil((time - minutes) / default_headway) * default_headway
+		return minutes
+
+
+def plan(graph: TransitGraph, departures: LiveDepartures, origins: Sequence[Tuple[int, float]],
+         destinations: Sequence[Tuple[int, float]]) -> List[Dict[str, Any]]:
+	"""
+	Compute earliest-arrival journeys with the RAPTOR algorithm: round k finds the best arrival times at every stop
+	using at most k vehicles, scanning only the patterns serving stops improved in the previous round.
+
+	Parameters
+	----------
+	graph network
+	departures live departures on the network
+	origins stops reachable from the origin, as (stop, minutes to reach it) tuples
+	destinations stops from which the destination is reachable, as (stop, minutes to reach the destination)
+
+	Returns
+	-------
+	Pareto-optimal journeys: each one uses more vehicles than the previous one but arrives earlier
+	"""
+	stop_count = len(graph.stations)
+	best = [INFINITY] * stop_count
+	rounds = [[INFINITY] * stop_count]
+	parents = [[None] * stop_count]  # type: List[List[Optional[Tuple]]]
+	egress = dict(destinations)
+
+	marked = set()
+	for stop, minutes in origins:
+		if minutes < rounds[0][stop]:
+			rounds[0][stop] = best[stop] = minutes
+			parents[0][stop] = ('origin',)
+			marked.add(stop)
+
+	target = INFINITY  # best arrival at the destination found so far
+	journeys = []
+
+	for k in range(1, max_rounds + 1):
+		previous = rounds[-1]
+		arrival = list(previous)
+		parent = [None] * stop_count
+		rounds.append(arrival)
+		parents.append(parent)
+
+		queue = {}  # type: Dict[int, int]
+		for stop in marked:
+			for pattern, position in graph.stop_patterns[stop]:
+				if position < queue.get(pattern, len(graph.pattern_stops[pattern])):
+					queue[pattern] = position
+
+		marked = set()
+		for pattern, start in queue.items():
+			stops = graph.pattern_stops[pattern]
+			ride_minutes = departures.ride_minutes[pattern]
+			time = None  # time of the boarded vehicle at the current stop
+			boarded_at = boarded_time = None
+			for position in range(start, len(stops)):
+				stop = stops[position]
+				if time is not None and time < min(best[stop], target):
+					arrival[stop] = best[stop] = time
+					parent[stop] = ('ride', pattern, boarded_at, boarded_time)
+					marked.add(stop)
+
+				if previous[stop] < INFINITY and (time is None or previous[stop] <= time):
+					departure = departures.departure(pattern, position, previous[stop])
+					if time is None or departure < time:
+						time, boarded_at, boarded_time = departure, position, departure
+
+				if time is not None and position < len(ride_minutes):
+					time += ride_minutes[position]
+
+		for stop in list(marked):
+			for other, minutes in graph.footpaths[stop]:
+				if arrival[stop] + minutes < min(best[other], target):
+					arrival[other] = best[other] = arrival[stop] + minutes
+					parent[other] = ('walk', stop)
+					marked.add(other)
+
+		for stop in marked:
+			if stop in egress and arrival[stop] + egress[stop] < target:
+				target = arrival[stop] + egress[stop]
+				journeys.append(_journey(graph, rounds, parents, k, stop, egress[stop]))
+
+		if not marked:
+			break
+
+	return journeys
+
+
+def _journey(graph: TransitGraph, rounds: List[List[float]], parents: List[List[Optional[Tuple]]], k: int,
+             stop: int, egress_minutes: float) -> Dict[str, Any]:
+	legs = [{'type': 'walk', 'from_station_id': graph.stations[stop].station_id, 'to_station_id': None,
+	         'departure': rounds[k][stop], 'arrival': rounds[k][stop] + egress_minutes}]
+	while True:
+		parent = parents[k][stop]
+		while parent is None:
+			# the stop was reached in an earlier round and not improved since
+			k -= 1
+			parent = parents[k][stop]
+
+		if parent[0] == 'origin':
+			legs.append({'type': 'walk', 'from_station_id': None, 'to_station_id': graph.stations[stop].station_id,
+			             'departure': 0, 'arrival': rounds[k][stop]})
+			break
+		elif parent[0] == 'walk':
+			previous = parent[1]
+			legs.append({'type': 'walk', 'from_station_id': graph.stations[previous].station_id,
+			             'to_station_id': graph.stations[stop].station_id,
+			             'departure': rounds[k][previous], 'arrival': rounds[k][stop]})
+			stop = previous
+		else:
+			_, pattern, boarded_at, boarded_time = parent
+			line_id, route_id = graph.patterns[pattern]
+			board_stop = graph.pattern_stops[pattern][boarded_at]
+			legs.append({'type': 'ride', 'line_id': line_id, 'route_id': route_id,
+			             'from_station_id': graph.stations[board_stop].station_id,
+			             'to_station_id': graph.stations[stop].station_id,
+			             'departure': boarded_time, 'arrival': rounds[k][stop]})
+			stop = board_stop
+			k -= 1
+
+	legs = [leg for leg in reversed(legs) if leg['type'] == 'ride' or leg['arrival'] > leg['departure']]
+	return {'arrival': legs[-1]['arrival'], 'rides': sum(1 for leg in legs if leg['type'] == 'ride'), 'legs': legs}
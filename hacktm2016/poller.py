@@ -0,0 +1,348 @@
+import logging
+import time
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import gevent
+import gevent.pool
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+	def __init__(self, value: Any, fetched_at: float):
+		self.value = value
+		self.fetched_at = fetched_at
+
+	@property
+	def age(self) -> float:
+		"""
+		Seconds elapsed since the value was fetched.
+		"""
+		return time.time() - self.fetched_at
+
+	def __repr__(self):
+		return "Snapshot(value=%r, fetched_at=%r)" % (self.value, self.fetched_at)
+
+
+class Demand:
+	"""
+	Exponentially decaying request counts per key: a request counts for 1 when it is made and for half as much every
+	`half_life` seconds later.
+	"""
+
+	def __init__(self, half_life: float):
+		self.half_life = half_life
+		self.scores = {}  # type: Dict[Hashable, Tuple[float, float]]
+
+	def add(self, key: Hashable, count: float = 1):
+		now = time.time()
+		self.scores[key] = (self.score(key, now) + count, now)
+
+	def score(self, key: Hashable, now: float = None) -> float:
+		score, updated_at = self.scores.get(key, (0.0, 0.0))
+		if not score:
+			return 0.0
+		now = time.time() if now is None else now
+		return score * 0.5 ** ((now - updated_at) / self.half_life)
+
+	def prune(self, min_score: float = 0.01):
+		"""
+		Forget the keys whose demand decayed below `min_score`.
+		"""
+		now = time.time()
+		for key in [key for key in self.scores if self.score(key, now) < min_score]:
+			del self.scores[key]
+
+
+class Poller:
+	"""
+	Keeps an in-memory snapshot of `fetch(key)` for every key returned by `keys()`, refreshed by a background
+	greenlet according to the demand for each key.
+
+	Every `get` of a key returned by `keys()` counts towards the demand of that key. Keys in demand are refreshed every `interval` seconds, keys
+	nobody asks for only every `cold_interval` seconds, and keys in between at intervals inversely proportional to
+	their demand; when refreshes compete for the `concurrency` slots, the keys in most demand go first.
+
+	Readers always get the last known snapshot immediately; a snapshot older than `interval` is refreshed in the
+	background (stale-while-revalidate), so a reader of a cold key gets a fresh snapshot on its next read.
+
+	Failed fetches are remembered for `retry_after` seconds: in the meantime, readers of a key without a snapshot get
+	the same error again and stale snapshots are served without refreshing them, instead of every reader waiting on
+	the failing upstream.
+
+	With a `shared` store (see caching.SqliteStore), several processes can poll together: the leader writes every
+	snapshot it fetches to the store, and the other processes refresh their snapshots from the store instead of
+	fetching, falling back to fetching only for keys the leader did not share yet. The other processes also add the
+	demand they see to the store, for the leader to schedule its refreshes on the demand of all processes.
+	"""
+
+	def __init__(self, name: str, fetch: Callable[[Hashable], Any], keys: Callable[[], Iterable[Hashable]],
+	             interval: float, concurrency: int = 4, retry_after: float = 10, shared=None,
+	             cold_interval: float = None, half_life: float = 600):
+		self.name = name
+		self.shared = shared
+		self.leader = True
+		self.fetch = fetch
+		self.keys = keys
+		self.interval = interval
+		self.cold_interval = max(interval, cold_interval if cold_interval is not None else interval)
+		# seconds between two checks for keys due for a refresh
+		self.tick = min(5.0, interval)
+		self.concurrency = concurrency
+		self.demand = Demand(half_life)
+		self._unshared_demand = {}  # type: Dict[Hashable, int]
+		self.retry_after = retry_after
+		self.failures = {}  # type: Dict[Hashable, Tuple[float, Exception]]
+		self.snapshots = {}  # type: Dict[Hashable, Snapshot]
+		self.latencies = {}  # type: Dict[Hashable, float]
+		self.errors = {}  # type: Dict[Hashable, int]
+		self.hits = self.misses = 0
+		self.listeners = []  # type: List[Callable[[Hashable, Snapshot], None]]
+		self._known_keys = frozenset()  # type: frozenset
+		self._known_keys_at = 0.0
+		self._refreshing = {}  # type: Dict[Hashable, gevent.Greenlet]
+		self._greenlet = None  # type: gevent.Greenlet
+
+	@property
+	def running(self) -> bool:
+		return self._greenlet is not None and not self._greenlet.dead
+
+	def refresh(self, key: Hashable) -> Snapshot:
+		"""
+		Fetch the value for `key` synchronously and store it as the current snapshot.
+		"""
+		if not self.leader and self.shared is not None:
+			snapshot = self._load_shared(key)
+			if snapshot is not None:
+				return snapshot
+
+		started = time.time()
+		try:
+			value = self.fetch(key)
+		except Exception as e:
+			self.errors[key] = self.errors.get(key, 0) + 1
+			self.failures[key] = (time.time(), e)
+			raise
+		finally:
+			self.latencies[key] = time.time() - started
+
+		self.failures.pop(key, None)
+		snapshot = Snapshot(value, time.time())
+		self._store(key, snapshot)
+		if self.shared is not None:
+			self.shared.set(self._shared_key(key), snapshot, snapshot.fetched_at + max(600.0, 10 * self.cold_interval))
+		return snapshot
+
+	def interval_for(self, key: Hashable) -> float:
+		"""
+		Seconds between two refreshes of `key`, from `interval` for keys in demand to `cold_interval` for keys nobody
+		asked for during the last half-lives.
+		"""
+		return max(self.interval, self.cold_interval / (1 + self.demand.score(key)))
+
+	def is_known(self, key: Hashable) -> bool:
+		"""
+		Whether `key` is one of the keys returned by `keys()`, which are read again at most every `tick` seconds.
+		"""
+		now = time.time()
+		if now - self._known_keys_at > self.tick:
+			self._known_keys = frozenset(self.keys())
+			self._known_keys_at = now
+		return key in self._known_keys
+
+	def _shared_key(self, key: Hashable) -> str:
+		return repr(('poller', self.name, key))
+
+	def _exchange_demand(self):
+		"""
+		Add the demand seen since the last exchange to the shared store, or, in the leader, take the demand added by
+		the other processes. Concurrent additions may be lost, which only makes the demand a little lower.
+		"""
+		demand_key = repr(('poller_demand', self.name))
+		if self.leader:
+			pending, expires_at = self.shared.get(demand_key)
+			if isinstance(pending, dict):
+				self.shared.delete(demand_key)
+				for key, count in pending.items():
+					if self.is_known(key):
+						self.demand.add(key, count)
+		elif self._unshared_demand:
+			pending, expires_at = self.shared.get(demand_key)
+			pending = pending if isinstance(pending, dict) else {}
+			for key, count in self._unshared_demand.items():
+				pending[key] = pending.get(key, 0) + count
+			self._unshared_demand = {}
+			self.shared.set(demand_key, pending, time.time() + self.demand.half_life)
+
+	def _load_shared(self, key: Hashable) -> Optional[Snapshot]:
+		"""
+		Replace the snapshot for `key` with the one in the shared store if that one is newer.
+
+		Returns
+		-------
+		The current snapshot, or None if the shared store has none for `key`
+		"""
+		shared_snapshot, expires_at = self.shared.get(self._shared_key(key))
+		if not isinstance(shared_snapshot, Snapshot):
+			return None
+
+		current = self.snapshots.get(key, None)
+		if current is None or shared_snapshot.fetched_at > current.fetched_at:
+			self._store(key, shared_snapshot)
+		return self.snapshots[key]
+
+	def _load_shared_quietly(self, key: Hashable):
+		try:
+			self._load_shared(key)
+		except Exception as e:
+			logger.warning("event=shared_load_failed poller=%s key=%r error=%r", self.name, key, str(e))
+
+	def _store(self, key: Hashable, snapshot: Snapshot):
+		self.snapshots[key] = snapshot
+		for listener in self.listeners:
+			try:
+				listener(key, snapshot)
+			except Exception:
+				logger.exception("event=poller_listener_failed poller=%s key=%r", self.name, key)
+
+	def _refresh_quietly(self, key: Hashable):
+		try:
+			self.refresh(key)
+		except Exception as e:
+			logger.warning("event=refresh_failed poller=%s key=%r error=%r", self.name, key, str(e))
+		finally:
+			self._refreshing.pop(key, None)
+
+	def get(self, key: Hashable) -> Snapshot:
+		"""
+		Get the last known snapshot for `key`, fetching it synchronously only if there is none yet.
+		"""
+		# only the known keys count, so that clients asking for anything cannot make the demand grow without bound
+		if self.is_known(key):
+			self.demand.add(key)
+			if self.shared is not None and not self.leader:
+				self._unshared_demand[key] = self._unshared_demand.get(key, 0) + 1
+
+		snapshot = self.snapshots.get(key, None)
+		failure = self.failures.get(key, None)
+		recently_failed = failure is not None and time.time() - failure[0] < self.retry_after
+		if snapshot is None:
+			self.misses += 1
+			if recently_failed:
+				raise failure[1].with_traceback(None)
+			return self.refresh(key)
+
+		self.hits += 1
+		if snapshot.age > self.interval and not recently_failed and key not in self._refreshing:
+			self._refreshing[key] = gevent.spawn(self._refresh_quietly, key)
+
+		return snapshot
+
+	def is_stale(self, key: Hashable) -> bool:
+		"""
+		Whether the last known snapshot for `key` is out of date: its last refresh failed, or it missed two refreshes.
+		"""
+		snapshot = self.snapshots.get(key, None)
+		if snapshot is None:
+			return False
+		failure = self.failures.get(key, None)
+		return (failure is not None and failure[0] > snapshot.fetched_at) or 0 < 2 * self.interval_for(key) < snapshot.age
+
+	def peek(self, key: Hashable) -> Optional[Snapshot]:
+		"""
+		Get the last known snapshot for `key` without fetching or refreshing it.
+		"""
+		return self.snapshots.get(key, None)
+
+	def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Snapshot]:
+		"""
+		Get the last known snapshots for several keys, fetching the missing ones concurrently.
+
+		Returns
+		-------
+		Snapshots by key; keys that could not be fetched are left out
+		"""
+		snapshots = {}
+
+		def get_quietly(key):
+			try:
+				snapshots[key] = self.get(key)
+			except Exception as e:
+				logger.warning("event=get_failed poller=%s key=%r error=%r", self.name, key, str(e))
+
+		pool = gevent.pool.Pool(self.concurrency)
+		for key in set(keys):
+			pool.spawn(get_quietly, key)
+		pool.join()
+		return snapshots
+
+	def refresh_all(self):
+		# followers only pick up what the leader shared; they fetch a key themselves only when a reader needs it
+		refresh = self._refresh_quietly if self.leader or self.shared is None else self._load_shared_quietly
+		pool = gevent.pool.Pool(self.concurrency)
+		for key in self.keys():
+			pool.spawn(refresh, key)
+		pool.join()
+
+	def refresh_due(self):
+		"""
+		Refresh the keys whose snapshot is older than their refresh interval, in decreasing order of demand.
+		"""
+		if self.shared is not None:
+			self._exchange_demand()
+		self.demand.prune()
+		# failures of keys no longer polled would otherwise be listed as failing forever
+		for key in [key for key in self.failures if not self.is_known(key)]:
+			del self.failures[key]
+
+		now = time.time()
+		due = []
+		for key in self.keys():
+			snapshot = self.snapshots.get(key, None)
+			failure = self.failures.get(key, None)
+			if snapshot is not None and now - snapshot.fetched_at < self.interval_for(key):
+				continue
+			if (failure is not None and now - failure[0] < self.retry_after) or key in self._refreshing:
+				continue
+			due.append((self.demand.score(key, now), key))
+		due.sort(key=lambda item: item[0], reverse=True)
+
+		refresh = self._refresh_quietly if self.leader or self.shared is None else self._load_shared_quietly
+		pool = gevent.pool.Pool(self.concurrency)
+		for score, key in due:
+			pool.spawn(refresh, key)
+		pool.join()
+
+	def _run(self):
+		while True:
+			started = time.time()
+			try:
+				self.refresh_due()
+			except Exception:
+				logger.exception("event=poller_refresh_failed poller=%s", self.name)
+			gevent.sleep(max(0.0, self.tick - (time.time() - started)))
+
+	def start(self):
+		if not self.running:
+			self._greenlet = gevent.spawn(self._run)
+
+	def stop(self):
+		if self._greenlet is not None:
+			self._greenlet.kill()
+			self._greenlet = None
+
+	def stats(self) -> Dict[str, Any]:
+		return {
+			'name': self.name,
+			'running': self.running,
+			'leader': self.leader,
+			'interval': self.interval,
+			'cold_interval': self.cold_interval,
+			'hits': self.hits,
+			'misses': self.misses,
+			'keys': [{'key': key, 'age': snapshot.age, 'latency': self.latencies.get(key, None),
+			          'errors': self.errors.get(key, 0), 'stale': self.is_stale(key),
+			          'demand': self.demand.score(key), 'interval': self.interval_for(key)}
+			         for key, snapshot in self.snapshots.items()],
+			'failing': [key for key in self.failures if key not in self.snapshots],
+		}
@@ -0,0 +1,104 @@
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Set, Tuple
+
+from flask import json
+from gevent.queue import Empty, Full, Queue
+
+
+class Subscription:
+	def __init__(self, topics: Iterable[str], queue_size: int):
+		self.topics = set(topics)
+		self.queue = Queue(queue_size)
+		self.closed = False
+
+	def events(self, timeout: float) -> Iterator[str]:
+		"""
+		Yield the server-sent events published to this subscription, or None after `timeout` seconds without any
+		event, until the subscription is closed.
+		"""
+		while not self.closed:
+			try:
+				event = self.queue.get(timeout=timeout)
+			except Empty:
+				yield None
+				continue
+
+			yield event
+
+
+def format_event(event: str, data: Any) -> str:
+	return "event: %s\ndata: %s\n\n" % (event, json.dumps(data, separators=(',', ':')))
+
+
+class Hub:
+	"""
+	Fans out events published on topics to the subscriptions of those topics.
+
+	Events are formatted once per publish, whatever the number of subscribers. A subscriber that does not keep up and
+	fills its queue is dropped instead of slowing down the publisher.
+	"""
+
+	def __init__(self, queue_size: int = 100):
+		self.queue_size = queue_size
+		self.subscriptions = {}  # type: Dict[str, Set[Subscription]]
+		self.dropped = 0
+
+	def subscribe(self, topics: Iterable[str]) -> Subscription:
+		subscription = Subscription(topics, self.queue_size)
+		for topic in subscription.topics:
+			self.subscriptions.setdefault(topic, set()).add(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription: Subscription):
+		subscription.closed = True
+		for topic in subscription.topics:
+			subscribers = self.subscriptions.get(topic, None)
+			if subscribers is not None:
+				subscribers.discard(subscription)
+				if not subscribers:
+					del self.subscriptions[topic]
+
+	def publish(self, topic: str, event: str, data: Any):
+		subscribers = self.subscriptions.get(topic, None)
+		if not subscribers:
+			return
+
+		message = format_event(event, data)
+		for subscription in list(subscribers):
+			try:
+				subscription.queue.put_nowait(message)
+			except Full:
+				self.dropped += 1
+				self.unsubscribe(subscription)
+
+	def stats(self) -> Dict[str, Any]:
+		return {'topics': {topic: len(subscribers) for topic, subscribers in self.subscriptions.items()},
+		        'dropped': self.dropped}
+
+
+class DiffPublisher:
+	"""
+	Keeps the last state of each topic, as items identified by a key, and publishes only the items whose compared
+	value changed between two successive states.
+	"""
+
+	def __init__(self, hub: Hub):
+		self.hub = hub
+		self.states = {}  # type: Dict[str, Dict[Hashable, Tuple[Any, Dict[str, Any]]]]
+
+	def update(self, topic: str, items: Dict[Hashable, Tuple[Any, Dict[str, Any]]]):
+		"""
+		Parameters
+		----------
+		topic topic the state belongs to
+		items (compared value, JSON representation) of each item of the new state, by item key
+		"""
+		previous = self.states.get(topic, {})
+		self.states[topic] = items
+
+		changed = [item for key, (value, item) in items.items() if key not in previous or previous[key][0] != value]
+		removed = [previous[key][1] for key in previous if key not in items]
+		if changed or removed:
+			self.hub.publish(topic, 'diff', {'topic': topic, 'changed': changed, 'removed': removed})
+
+	def state(self, topic: str) -> List[Dict[str, Any]]:
+		return [item for value, item in self.states.get(topic, {}).values()]
@@ -1,35 +1,66 @@
+import collections
+import hashlib
+import html
+import logging
 import re
-from typing import List, Sequence, Dict, Tuple, Union
+from typing import Any, Callable, Deque, List, Optional, Sequence, Dict, Tuple, Union
 from datetime import datetime, time, timedelta
+from os import environ
+from time import time as unix_time
 import pytz
-import tzlocal
-import traceback
 import bs4
 import requests
-import grequests
 
+import batching
 import importer
+import metrics
+import upstream
 
-station_time_url = 'http://www.ratt.ro/txt/afis_msg.php'
+# base urls of the upstream servers, overridable to point at a simulator (see simulator.py)
+infotrafic_url = environ.get('INFOTRAFIC_URL', 'http://86.122.170.105:61978/html/timpi/')
+station_time_url = environ.get('RATT_TXT_URL', 'http://www.ratt.ro/txt/') + 'afis_msg.php'
+
+timezone = pytz.timezone("Europe/Bucharest")
+
+logger = logging.getLogger(__name__)
+
+parse_seconds = metrics.histogram('page_parse_duration_seconds', "Time spent parsing infotrafic pages.", ['page', 'parser'],
+                                  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+unknown_lines_total = metrics.counter('unknown_lines_total', "Lines found on infotrafic but missing from the lines csv.")
+unknown_stations_total = metrics.counter('unknown_stations_total',
+                                         "Stations found on infotrafic but missing from the stations csv.")
+stations_without_coordinates_total = metrics.counter('stations_without_coordinates_total',
+                                                     "Stations found on infotrafic without GPS coordinates in the stations csv.")
 
 
 class Arrival:
-	def __init__(self, line_id: int, station_id: int, arrival: str, minutes_left: int, is_real_time: bool):
+	__slots__ = ('line_id', 'station_id', 'arrival', 'is_real_time', 'minutes_left', 'is_predicted')
+
+	def __init__(self, line_id: int, station_id: int, arrival: str, minutes_left: int, is_real_time: bool,
+	             is_predicted: bool = False):
 		self.line_id = line_id
 		self.station_id = station_id
 		self.arrival = arrival
 		self.is_real_time = is_real_time
 		self.minutes_left = minutes_left
+		# estimated from the travel times observed on the route instead of read from the timetable (see history.py)
+		self.is_predicted = is_predicted
+
+	def to_json(self) -> Dict[str, Any]:
+		return {'line_id': self.line_id, 'station_id': self.station_id, 'arrival': self.arrival,
+		        'is_real_time': self.is_real_time, 'minutes_left': self.minutes_left, 'is_predicted': self.is_predicted}
 
 	def __repr__(self):
-		return "Arrival(line_id=%r, station_id=%r, arrival=%r, minutes_left=%r, is_real_time=%r)" % \
-		       (self.line_id, self.station_id, self.arrival, self.minutes_left, self.is_real_time)
+		return "Arrival(line_id=%r, station_id=%r, arrival=%r, minutes_left=%r, is_real_time=%r, is_predicted=%r)" % \
+		       (self.line_id, self.station_id, self.arrival, self.minutes_left, self.is_real_time, self.is_predicted)
 
 	def __str__(self):
 		return self.arrival
 
 
 class Station:
+	__slots__ = ('station_id', 'raw_name', 'friendly_name', 'junction_name', 'lat', 'lng', 'poi_url')
+
 	def __init__(self, station_id: int, raw_name: str, friendly_name: str, junction_name: str, lat: float, lng: float, poi_url: str):
 		self.station_id = station_id
 		self.raw_name = raw_name
@@ -39,6 +70,10 @@ class Station:
 		self.lng = float(lng) if lng is not None else None
 		self.poi_url = poi_url
 
+	def to_json(self) -> Dict[str, Any]:
+		return {'station_id': self.station_id, 'raw_name': self.raw_name, 'friendly_name': self.friendly_name,
+		        'junction_name': self.junction_name, 'lat': self.lat, 'lng': self.lng, 'poi_url': self.poi_url}
+
 	def __str__(self):
 		return self.friendly_name
 
@@ -57,6 +92,8 @@ class Station:
 
 
 class Line:
+	__slots__ = ('line_id', 'line_name', 'friendly_name', 'line_type', 'route_name_1', 'route_name_2')
+
 	def __init__(self, line_id: int, line_name: str, friendly_name: str, line_type: str, route_name_1: str, route_name_2: str):
 		self.line_id = line_id
 		self.line_name = line_name
@@ -65,6 +102,10 @@ class Line:
 		self.route_name_1 = route_name_1
 		self.route_name_2 = route_name_2
 
+	def to_json(self) -> Dict[str, Any]:
+		return {'line_id': self.line_id, 'line_name': self.line_name, 'friendly_name': self.friendly_name,
+		        'line_type': self.line_type, 'route_name_1': self.route_name_1, 'route_name_2': self.route_name_2}
+
 	def __str__(self):
 		return self.friendly_name
 
@@ -83,12 +124,18 @@ class Line:
 
 
 class Route:
+	__slots__ = ('route_id', 'route_name', 'line_id', 'stations')
+
 	def __init__(self, route_id: int, route_name: str, line_id: int, stations: Sequence[Station]):
 		self.route_id = route_id
 		self.route_name = route_name
 		self.line_id = line_id
 		self.stations = stations
 
+	def to_json(self) -> Dict[str, Any]:
+		return {'line_id': self.line_id, 'route_id': self.route_id, 'route_name': self.route_name,
+		        'stations': [station.to_json() for station in self.stations]}
+
 	def __str__(self):
 		return self.route_name
 
@@ -106,6 +153,32 @@ class Route:
 		return hash(self.line_id) * 101 + hash(self.route_id)
 
 
+class StationRoutesIndex:
+	"""
+	Inverted index from stations to the routes serving them, as (line_id, route_id, position in route) tuples.
+	"""
+
+	def __init__(self, routes: Dict[int, Tuple[Route, Route]]):
+		self.by_station_id = {}  # type: Dict[int, List[Tuple[int, int, int]]]
+		self.by_junction = {}  # type: Dict[str, List[Tuple[int, int, int]]]
+		for line_routes in routes.values():
+			for route in line_routes:
+				for position, station in enumerate(route.stations):
+					stop = (route.line_id, route.route_id, position)
+					self.by_station_id.setdefault(station.station_id, []).append(stop)
+					if station.junction_name:
+						self.by_junction.setdefault(station.junction_name, []).append(stop)
+
+	def get_by_station_id(self, station_id: int) -> List[Tuple[int, int, int]]:
+		return self.by_station_id.get(station_id, [])
+
+	def get_by_junction(self, junction_name: str) -> List[Tuple[int, int, int]]:
+		return self.by_junction.get(junction_name, [])
+
+	def serves(self, station_id: int, line_id: int) -> bool:
+		return any(stop[0] == line_id for stop in self.get_by_station_id(station_id))
+
+
 def parse_arrival(now: datetime, line_id: int, station_id: int, arrival: str) -> Arrival:
 	"""
 	Parse arrival time from a string of the form "hh:mm", "mm min.", ">>".
@@ -160,153 +233,503 @@ def parse_arrival_from_response(now: datetime, line_id: int, station_id: int, re
 	-------
 	Parsed arrival time
 	"""
+	return parse_arrival(now, line_id, station_id, _arrival_from_response(response))
+
+
+def _arrival_from_response(response: requests.Response) -> str:
 	response.raise_for_status()
 	arrival = "xx:xx"  # type: str
 	if response.status_code == requests.codes.ok:
 		arrival = parse_arrival_from_response.arrival_re.search(response.text).group(1)
 
-	return parse_arrival(now, line_id, station_id, arrival)
+	return arrival
 
 
-parse_arrival_from_response.arrival_re = re.compile("Sosire1:[\s]*([^\n\r<]+)")
+parse_arrival_from_response.arrival_re = re.compile(r"Sosire1:[\s]*([^\n\r<]+)")
 parse_arrival.estimate_re = re.compile("^(\d*)\s*min\.?$")
 parse_arrival.schedule_re = re.compile("^([0-9]|0[0-9]|1[0-9]|2[0-3]):([0-5][0-9])$")
 parse_arrival.in_station_re = re.compile("^\s*>+\s*$")
 
 
-def exception_handler(request: grequests.AsyncRequest, exception: Exception):
-	print("Exception while handling request %s:\n%s" % (str(request.url), str(exception)))
+def local_now() -> datetime:
+	"""
+	Current time in Europe/Bucharest timezone, truncated to the minute; computed once per minute.
+	"""
+	minute = int(unix_time() // 60)
+	if local_now.cached[0] != minute:
+		local_now.cached = (minute, datetime.fromtimestamp(minute * 60, pytz.utc).astimezone(timezone))
+	return local_now.cached[1]
 
 
-def get_line_times(line_id: int, station_ids: List[int]) -> Sequence[Arrival]:
+local_now.cached = (None, None)
+
+
+def _constant_offset(now: datetime) -> bool:
 	"""
-	Get all arrival times for a given line by individual requests to http://www.ratt.ro/txt/
+	Whether the UTC offset stays the same from the start of the day of `now` until a day after `now`, i.e. whether
+	minutes until a "hh:mm" arrival can be computed from wall clock minutes alone.
+	"""
+	tz = now.tzinfo
+	midnight = tz.localize(datetime.combine(now.date(), time()))
+	return midnight.utcoffset() == now.utcoffset() == tz.normalize(now + timedelta(days=1)).utcoffset()
+
+
+def parse_arrivals(now: datetime, line_id: int, station_ids: Sequence[int], arrivals: Sequence[str]) -> List[Arrival]:
+	"""
+	Parse the arrival strings of a whole page at once, with the same results as `parse_arrival` on each string.
+
+	A single pattern recognizes all arrival formats, and minutes until "hh:mm" arrivals are computed from the
+	minute of the day of `now`, except on the days when the UTC offset changes, which take the timezone-aware path
+	of `parse_arrival`.
+
 	Parameters
 	----------
-	line_id
-	station_ids
+	now current time in Europe/Bucharest timezone
+	line_id line ID
+	station_ids station ID of each arrival
+	arrivals arrival strings
 
 	Returns
 	-------
-	Station arrival times.
+	Parsed arrival times, in the order of `arrivals`
 	"""
-	gets = []
-	for station_id in station_ids:
-		params = {'id_traseu': line_id, 'id_statie': station_id}
-		gets.append(grequests.get(station_time_url, params=params, stream=False))
-
-	arrivals = []
-	responses = list(grequests.map(gets, exception_handler=exception_handler, size=20))
-	tz = pytz.timezone("Europe/Bucharest")
-	now = tzlocal.get_localzone().localize(datetime.now()).astimezone(tz).replace(second=0, microsecond=0)
-	for index, response in enumerate(responses):
+	match = parse_arrivals.arrival_re.match
+	wall_clock = now.second == 0 and now.microsecond == 0 and _constant_offset(now)
+	now_minute = now.hour * 60 + now.minute
+	parsed = []
+	for station_id, arrival in zip(station_ids, arrivals):
+		matched = match(arrival)
+		if matched is None:
+			parsed.append(Arrival(line_id, station_id, arrival, -1, False))
+		elif matched.lastindex == 1:
+			parsed.append(Arrival(line_id, station_id, arrival.strip('.'), int(matched.group(1)), True))
+		elif matched.lastindex == 3:
+			if wall_clock:
+				minutes_left = (int(matched.group(2)) * 60 + int(matched.group(3)) - now_minute) % (24 * 60)
+				parsed.append(Arrival(line_id, station_id, arrival, minutes_left, False))
+			else:
+				parsed.append(parse_arrival(now, line_id, station_id, arrival))
+		else:
+			parsed.append(Arrival(line_id, station_id, arrival.strip(), 0, True))
+
+	return parsed
+
+
+# the patterns of parse_arrival as alternatives; the group matched last tells which one matched
+parse_arrivals.arrival_re = re.compile(r"^(?:(\d*)\s*min\.?|([0-9]|0[0-9]|1[0-9]|2[0-3]):([0-5][0-9])|(\s*>+\s*))$")
+
+
+def _fetch_station_times(pairs: List[Tuple[int, int]]) -> List[Optional[str]]:
+	"""
+	Fetch the next arrival of each (line ID, station ID) pair from http://www.ratt.ro/txt/, as an unparsed string.
+
+	Returns
+	-------
+	Arrival strings in the order of `pairs`, with None for the pairs that could not be fetched
+	"""
+	responses = upstream.get_all([(station_time_url, {'id_traseu': line_id, 'id_statie': station_id})
+	                              for line_id, station_id in pairs], size=upstream.get_host(station_time_url).concurrency)
+	arrivals = []  # type: List[Optional[str]]
+	for (line_id, station_id), response in zip(pairs, responses):
+		if response is None:
+			arrivals.append(None)
+			continue
 		try:
-			arrivals.append(parse_arrival_from_response(now, line_id, station_ids[index], response))
+			arrivals.append(_arrival_from_response(response))
 		except Exception:
-			traceback.print_exc()
-			print(response.text)
-			arrivals.append(Arrival(line_id, station_ids[index], "xx:xx", -1, False))
+			logger.exception("event=unparsable_arrival line_id=%d station_id=%d body=%r", line_id, station_id,
+			                 response.text)
+			arrivals.append(None)
 		finally:
 			response.close()
 
 	return arrivals
 
 
+# (line ID, station ID) pairs requested at about the same time, e.g. by concurrent get_line_times calls, are fetched
+# in one batch, at most once, and cached for as long as the estimates stay accurate to the minute
+station_times = batching.Batcher(_fetch_station_times, window=float(environ.get('STATION_TIMES_WINDOW', '0.05')),
+                                 expire=float(environ.get('STATION_TIMES_EXPIRE', '30')))
+
+
+def get_line_times(line_id: int, station_ids: List[int]) -> Sequence[Arrival]:
+	"""
+	Get all arrival times for a given line by individual requests to http://www.ratt.ro/txt/
+	Parameters
+	----------
+	line_id
+	station_ids
+
+	Returns
+	-------
+	Arrival times in the order of `station_ids`; "xx:xx" for the stations whose arrival could not be fetched
+	"""
+	arrivals = station_times.get_many([(line_id, station_id) for station_id in station_ids])
+	return parse_arrivals(local_now(), line_id, station_ids,
+	                      [arrival if arrival is not None else "xx:xx" for arrival in arrivals])
+
+
+def get_arrivals_from_station_times(line_id: int, routes: Tuple[Route, Route]) -> Tuple[Sequence[Arrival], Sequence[Arrival]]:
+	"""
+	Get the arrivals of both routes of a line from http://www.ratt.ro/txt/, station by station; slower than
+	`get_arrivals_from_infotrafic`, for when infotrafic is unavailable.
+	"""
+	pairs = [(line_id, station.station_id) for route in routes for station in route.stations]
+	arrivals = station_times.get_many(pairs)
+	if all(arrival is None for arrival in arrivals):
+		raise requests.ConnectionError("no arrivals of line %d could be fetched from %s" % (line_id, station_time_url))
+
+	parsed = parse_arrivals(local_now(), line_id, [station_id for _, station_id in pairs],
+	                        [arrival if arrival is not None else "xx:xx" for arrival in arrivals])
+	first_route_length = len(routes[0].stations)
+	return parsed[:first_route_length], parsed[first_route_length:]
+
+
+def _infotrafic_rows_bs4(text: str) -> List[Tuple[str, List[str]]]:
+	"""
+	Extract the (background color, bold texts) of every table in an infotrafic line page using BeautifulSoup.
+	"""
+	bs = bs4.BeautifulSoup(text, "html.parser")
+	return [(table['bgcolor'], [b.text for b in table.find_all("b")]) for table in bs.find_all("table")]
+
+
+def _infotrafic_rows_fast(text: str) -> Optional[List[Tuple[str, List[str]]]]:
+	"""
+	Extract the (background color, bold texts) of every table in an infotrafic line page with a regex tokenizer.
+
+	Returns
+	-------
+	Same rows as `_infotrafic_rows_bs4`, or None if the page has a structure the tokenizer does not handle, in which
+	case the caller should fall back to `_infotrafic_rows_bs4`
+	"""
+	text = _infotrafic_rows_fast.comment_re.sub('', text)
+	rows = []
+	open_tables = []  # indices in `rows` of the tables enclosing the current position
+	bold_start = None
+	tag_re = _infotrafic_rows_fast.table_or_bold_re
+	if _infotrafic_rows_fast.quoted_bracket_re.search(text):
+		# a quoted attribute value may contain what looks like a tag: every tag has to be matched to skip those
+		tag_re = _infotrafic_rows_fast.tag_re
+	for tag in tag_re.finditer(text):
+		closing, name = tag.group(1), tag.group(2).lower()
+		if name == 'table':
+			if closing:
+				if not open_tables:
+					return None
+				open_tables.pop()
+			else:
+				bgcolor = None
+				for attribute in _infotrafic_rows_fast.attribute_re.finditer(tag.group(3)):
+					if attribute.group(1).lower() == 'bgcolor':
+						bgcolor = html.unescape(attribute.group(2) or attribute.group(3) or attribute.group(4) or '')
+				if bgcolor is None:
+					return None
+				open_tables.append(len(rows))
+				rows.append((bgcolor, []))
+		elif name != 'b':
+			continue
+		elif closing:
+			if bold_start is None:
+				return None
+			bold = html.unescape(_infotrafic_rows_fast.tag_re.sub('', text[bold_start:tag.start()]))
+			for index in open_tables:
+				rows[index][1].append(bold)
+			bold_start = None
+		else:
+			if bold_start is not None:
+				return None
+			bold_start = tag.end()
+
+	if open_tables or bold_start is not None:
+		return None
+
+	return rows
+
+
+_infotrafic_rows_fast.comment_re = re.compile(r"<!--.*?-->", re.DOTALL)
+# a start or end tag, with its attributes, which may contain '<' or '>' inside quoted values
+_infotrafic_rows_fast.tag_re = re.compile(r"""<(/?)([A-Za-z][^\s/>]*)((?:=\s*"[^"]*"|=\s*'[^']*'|[^>])*)>""")
+_infotrafic_rows_fast.table_or_bold_re = re.compile(r"<(/?)(table|b)\b([^>]*)>", re.IGNORECASE)
+_infotrafic_rows_fast.quoted_bracket_re = re.compile(r"""=\s*(?:"[^"]*[<>]|'[^']*[<>])""")
+# an attribute of a tag, with its double quoted, single quoted or bare value
+_infotrafic_rows_fast.attribute_re = re.compile(r"""([^\s"'=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?""")
+
+
 def parse_arrivals_from_infotrafic(line_id: int, stations: Dict[str, Station], response: requests.Response, include_unknown_stations: bool = False) -> Tuple[List[Tuple[Union[Station,str], Arrival]]]:
 	response.raise_for_status()
 	if response.status_code == requests.codes.ok:
-		bs = bs4.BeautifulSoup(response.text, "html.parser")
+		with parse_seconds.labels('line', 'fast').time():
+			rows = _infotrafic_rows_fast(response.text)
+		if rows is None:
+			with parse_seconds.labels('line', 'bs4').time():
+				rows = _infotrafic_rows_bs4(response.text)
+
 		prevcolor = None
 		datacolor = '00BFFF'
 		routes = []
 		route = None
-		tz = pytz.timezone("Europe/Bucharest")
-		now = tzlocal.get_localzone().localize(datetime.now()).astimezone(tz).replace(second=0, microsecond=0)
-		for row in bs.find_all("table"):
-			if row['bgcolor'] == datacolor:
+		entries = []  # (route, station or raw station name, arrival string) of every station to add to a route
+		for bgcolor, cols in rows:
+			if bgcolor == datacolor:
 				if prevcolor != datacolor:
 					route = []
 					routes.append(route)
 
-				cols = row.find_all("b")
-				raw_station_name = cols[1].text.strip()
+				raw_station_name = cols[1].strip()
 				station = stations.get(raw_station_name, None)
-				arrival = parse_arrival(now, line_id, station.station_id if station else -1, cols[2].text)
 				if station is not None or include_unknown_stations:
-					route.append((station if station is not None else raw_station_name, arrival))
+					entries.append((route, station if station is not None else raw_station_name, cols[2]))
 
-			prevcolor = row['bgcolor']
+			prevcolor = bgcolor
+
+		arrivals = parse_arrivals(local_now(), line_id,
+		                          [station.station_id if isinstance(station, Station) else -1 for _, station, _ in entries],
+		                          [arrival for _, _, arrival in entries])
+		for (entry_route, station, _), arrival in zip(entries, arrivals):
+			entry_route.append((station, arrival))
 
 		return routes if route else None
 
 	return None
 
 
+def _route_signature(routes: List[List[Tuple[Union[Station, str], Arrival]]]) -> str:
+	"""
+	Hash of the station names of every route of a line page, which changes only when the routes of the line do.
+	"""
+	names = "\n\n".join("\n".join(station.raw_name if isinstance(station, Station) else station for station, _ in route)
+	                      for route in routes)
+	return hashlib.sha1(names.encode('utf-8')).hexdigest()
+
+
+class RouteDiscovery:
+	"""
+	Routes of every line listed on infotrafic, kept up to date incrementally: the routes of a line are rebuilt only
+	when the signature of the stations on its page changes, and every change is appended to a change log.
+
+	Line pages are fetched for arrivals all the time anyway (see `get_arrivals_from_infotrafic`), so `update_line`
+	is fed the parsed pages and `discover` only fetches the index pages and the lines not checked for `max_age`.
+
+	Parameters
+	----------
+	known_lines_csv, known_stations_csv files with the known lines and stations
+	max_changes number of changes kept in the change log
+	"""
+
+	def __init__(self, known_lines_csv: str, known_stations_csv: str, max_changes: int = 200):
+		self.known_lines_csv = known_lines_csv
+		self.known_stations_csv = known_stations_csv
+		# replaced by a new dict on every change, so that values derived from it can tell when it changed
+		self.routes = {}  # type: Dict[int, Tuple[Route, Route]]
+		self.signatures = {}  # type: Dict[int, str]
+		self.checked_at = {}  # type: Dict[int, float]
+		self.changes = collections.deque(maxlen=max_changes)  # type: Deque[Dict[str, Any]]
+		# called with the new routes after every change, once the whole network was seeded or discovered
+		self.listeners = []  # type: List[Callable[[Dict[int, Tuple[Route, Route]]], None]]
+		self.complete = False
+		self.pages_changed = self.pages_unchanged = 0
+
+	def seed(self, routes: Dict[int, Tuple[Route, Route]]):
+		"""
+		Start from previously discovered routes, e.g. of a snapshot, for the lines not checked yet.
+		"""
+		seeded = dict(routes)
+		seeded.update(self.routes)
+		self.routes = seeded
+		self.complete = True
+
+	def adopt(self, routes: Dict[int, Tuple[Route, Route]]):
+		"""
+		Replace the routes by those discovered by another process, e.g. the leader of a pre-forked server.
+		"""
+		self.routes = dict(routes)
+		self.complete = True
+
+	def update_line(self, line_id: int, page_routes: List[List[Tuple[Union[Station, str], Arrival]]],
+	                known_lines: Dict[int, Line] = None) -> bool:
+		"""
+		Update the routes of a line from its parsed page, including the unknown stations.
+
+		Returns
+		-------
+		Whether the routes of the line changed
+		"""
+		if not page_routes:
+			# an empty page is more likely an infotrafic hiccup than a line without stations
+			return False
+
+		self.checked_at[line_id] = unix_time()
+		signature = _route_signature(page_routes)
+		if self.signatures.get(line_id, None) == signature:
+			self.pages_unchanged += 1
+			return False
+
+		self.signatures[line_id] = signature
+		self.pages_changed += 1
+		if known_lines is None:
+			known_lines = importer.import_lines(self.known_lines_csv).by_line_id
+		line_routes = _build_line_routes(line_id, known_lines.get(line_id, None), page_routes)
+		previous = self.routes.get(line_id, None)
+		changes = _route_changes(line_id, previous, line_routes)
+		if not changes:
+			return False
+
+		routes = dict(self.routes)
+		if line_routes is None:
+			del routes[line_id]
+		else:
+			routes[line_id] = line_routes
+		self._changed(routes, changes)
+		return True
+
+	def remove_line(self, line_id: int):
+		self.signatures.pop(line_id, None)
+		self.checked_at.pop(line_id, None)
+		if line_id in self.routes:
+			routes = dict(self.routes)
+			del routes[line_id]
+			self._changed(routes, [{'change': 'line_removed', 'line_id': line_id}])
+
+	def _changed(self, routes: Dict[int, Tuple[Route, Route]], changes: List[Dict[str, Any]]):
+		self.routes = routes
+		if not self.complete:
+			# still discovering the network for the first time, there is nothing to compare with
+			return
+
+		for change in changes:
+			change['at'] = unix_time()
+			self.changes.append(change)
+			logger.info("event=route_change %s", " ".join("%s=%s" % (key, change[key]) for key in sorted(change)))
+
+		for listener in self.listeners:
+			listener(routes)
+
+	def discover(self, max_age: float = 0) -> Dict[int, Tuple[Route, Route]]:
+		"""
+		Fetch the lines listed on the index pages, drop the lines no longer listed and update the lines not checked
+		in the last `max_age` seconds.
+		"""
+		root = infotrafic_url
+		urls = [(root + 'tram.php', None),
+		        (root + 'trol.php', None),
+		        (root + 'auto.php', None)]
+
+		known_lines = importer.import_lines(self.known_lines_csv).by_line_id  # type: Dict[int, Line]
+		known_stations = importer.import_stations(self.known_stations_csv).by_raw_name  # type: Dict[str, Station]
+		line_id_re = re.compile("param1=(\d+)")
+		listed = set()
+		loaded_pages = 0
+		line_requests = []
+		for page in upstream.get_each(urls, size=len(urls)):
+			page.raise_for_status()
+			if page.status_code == requests.codes.ok:
+				loaded_pages += 1
+				with parse_seconds.labels('index', 'bs4').time():
+					soup = bs4.BeautifulSoup(page.text, "html.parser")
+				for a in soup.select("div p a"):
+					line_id = int(line_id_re.search(a['href']).group(1))
+					listed.add(line_id)
+					line = known_lines.get(line_id, None)
+					if not line:
+						line_name = a['title'] if a.has_attr('title') else None
+						if line_name is None:
+							img = a.select("img")[0]
+							line_name = img['alt'] if img and img.has_attr('alt') else 'unknown'
+						unknown_lines_total.inc()
+						logger.warning("event=unknown_line line_id=%d line_name=%r url=%s", line_id, line_name, page.url)
+					if unix_time() - self.checked_at.get(line_id, 0) >= max_age:
+						line_requests.append((root + a['href'], None))
+
+		if not listed:
+			# infotrafic is unavailable or empty; don't mistake that for every line being removed
+			return self.routes
+
+		# a line missing from the index can only be told apart from a page that failed to load when all pages did
+		if loaded_pages == len(urls):
+			for line_id in (set(self.routes) | set(self.signatures)) - listed:
+				self.remove_line(line_id)
+		else:
+			logger.warning("event=index_incomplete loaded_pages=%d pages=%d", loaded_pages, len(urls))
+
+		for line_response in upstream.get_each(line_requests, size=6):
+			line_id = int(line_id_re.search(line_response.url).group(1))
+			page_routes = parse_arrivals_from_infotrafic(line_id, known_stations, line_response, include_unknown_stations=True)
+			self.update_line(line_id, page_routes, known_lines)
+
+		self.complete = True
+		return self.routes
+
+	def stats(self) -> Dict[str, Any]:
+		return {'lines': len(self.routes), 'checked': len(self.checked_at), 'pages_changed': self.pages_changed,
+		        'pages_unchanged': self.pages_unchanged, 'changes': len(self.changes)}
+
+
+def _build_line_routes(line_id: int, line: Optional[Line],
+                       page_routes: List[List[Tuple[Union[Station, str], Arrival]]]) -> Optional[Tuple[Route, Route]]:
+	line_name = line.line_name if line is not None else "unknown"
+	route1 = route2 = None
+	for route_id, route in enumerate(page_routes):
+		valid_stations = []
+		for station, arrival in route:
+			if not isinstance(station, Station):
+				unknown_stations_total.inc()
+				logger.warning("event=unknown_station raw_station_name=%r line_id=%d line_name=%r route_id=%d",
+				               station, line_id, line_name, route_id)
+			else:
+				if not station.lng or not station.lat:
+					stations_without_coordinates_total.inc()
+					logger.warning("event=station_without_coordinates station_id=%d station_name=%r",
+					               station.station_id, station.friendly_name)
+				valid_stations.append(station)
+
+		if valid_stations and line is not None:
+			if route_id == 0:
+				route1 = Route(route_id, line.route_name_1, line.line_id, valid_stations)
+			elif route_id == 1:
+				route2 = Route(route_id, line.route_name_2, line.line_id, valid_stations)
+
+	if route1 is not None and route2 is not None:
+		return route1, route2
+	return None
+
+
+def _route_changes(line_id: int, previous: Optional[Tuple[Route, Route]],
+                   current: Optional[Tuple[Route, Route]]) -> List[Dict[str, Any]]:
+	"""
+	Differences between two versions of the routes of a line, as change log entries.
+	"""
+	if previous is None:
+		return [{'change': 'line_added', 'line_id': line_id}] if current is not None else []
+	if current is None:
+		return [{'change': 'line_removed', 'line_id': line_id}]
+
+	changes = []
+	for old_route, new_route in zip(previous, current):
+		old_ids = [station.station_id for station in old_route.stations]
+		new_ids = [station.station_id for station in new_route.stations]
+		if old_ids != new_ids:
+			changes.append({'change': 'route_changed', 'line_id': line_id, 'route_id': new_route.route_id,
+			                'added_stations': [station_id for station_id in new_ids if station_id not in old_ids],
+			                'removed_stations': [station_id for station_id in old_ids if station_id not in new_ids]})
+	return changes
+
+
 def get_route_info_from_infotraffic(known_lines_csv: str, known_stations_csv: str)-> Dict[int, Tuple[Route, Route]]:
-	root = 'http://86.122.170.105:61978/html/timpi/'
-	urls = [grequests.get(root + 'tram.php', stream=False),
-	        grequests.get(root + 'trol.php', stream=False),
-	        grequests.get(root + 'auto.php', stream=False)]
-
-	known_lines = { line.line_id: line for line in importer.parse_lines_from_csv(known_lines_csv) }
-	known_lines = known_lines  # type: Dict[int, Line]
-	known_stations = { station.raw_name: station for station in importer.parse_stations_from_csv(known_stations_csv) }
-	known_stations = known_stations  # type: Dict[str, Station]
-	line_id_re = re.compile("param1=(\d+)")
-	line_id_to_routes = {}  # type: Dict[int, Tuple[Route, Route]]
-	for page in grequests.imap(urls, size=len(urls), exception_handler=exception_handler):
-		page.raise_for_status()
-		if page.status_code == requests.codes.ok:
-			soup = bs4.BeautifulSoup(page.text, "html.parser")
-			unknown_lines = { }  # type: Dict[int, str]
-			line_requests = []
-			for a in soup.select("div p a"):
-				line_id = int(line_id_re.search(a['href']).group(1))
-				line = known_lines.get(line_id, None)
-				if not line:
-					line_name = a['title'] if a.has_attr('title') else None
-					if line_name is None:
-						img = a.select("img")[0]
-						line_name = img['alt'] if img and img.has_attr('alt') else 'unknown'
-					unknown_lines[line_id] = line_name
-					print("WARNING: unknown line '{line_name}' (line ID: {line_id}) encountered at {url}"
-					      .format(line_name=line_name, line_id=line_id, url=page.url))
-				line_requests.append(grequests.get(root + a['href'], stream=False))
-
-			for line_response in grequests.imap(line_requests, size=6, exception_handler=exception_handler):
-				line_id = int(line_id_re.search(line_response.url).group(1))
-				routes = parse_arrivals_from_infotrafic(line_id, known_stations, line_response, include_unknown_stations=True)
-				line = known_lines.get(line_id, None)
-				line_name = line.line_name if line is not None else unknown_lines.get(line_id, "unknown")
-				route1 = route2 = None
-				for route_id, route in enumerate(routes):
-					valid_stations = []
-					for station, arrival in route:
-						if not isinstance(station, Station):
-							print("WARNING: unknown station '{raw_station_name}' encountered in route {route_id} of line {line_name} (line ID: {line_id})"
-							      .format(line_name=line_name, line_id=line_id, route_id=route_id, raw_station_name=station))
-						else:
-							if not station.lng or not station.lat:
-								print("WARNING: station '{station_name}' (station ID: {station_id}) has no GPS coordinates defined"
-								      .format(station_name=station.friendly_name, station_id=station.station_id))
-							valid_stations.append(station)
-
-					if valid_stations and line is not None:
-						if route_id == 0:
-							route1 = Route(route_id, line.route_name_1, line.line_id, valid_stations)
-						elif route_id == 1:
-							route2 = Route(route_id, line.route_name_2, line.line_id, valid_stations)
-
-				if route1 is not None and route2 is not None:
-					line_id_to_routes[line.line_id] = (route1, route2)
-
-	return line_id_to_routes
-
-
-def get_arrivals_from_infotrafic(line_id: int, stations: Dict[str, Station]) -> Tuple[Sequence[Arrival], Sequence[Arrival]]:
-	response = requests.get('http://86.122.170.105:61978/html/timpi/sens0.php', params={'param1': line_id})
-	routes = parse_arrivals_from_infotrafic(line_id, stations, response)
-	return [arrival for station, arrival in routes[0]], [arrival for station, arrival in routes[1]]
+	return RouteDiscovery(known_lines_csv, known_stations_csv).discover()
+
+
+def get_arrivals_from_infotrafic(line_id: int, stations: Dict[str, Station],
+                                 discovery: RouteDiscovery = None) -> Tuple[Sequence[Arrival], Sequence[Arrival]]:
+	"""
+	Fetch the arrivals of both routes of a line; the page is also passed on to `discovery`, if given, to keep the
+	routes of the line up to date.
+	"""
+	response = upstream.get(infotrafic_url + 'sens0.php', params={'param1': line_id})
+	routes = parse_arrivals_from_infotrafic(line_id, stations, response, include_unknown_stations=discovery is not None)
+	if discovery is not None:
+		discovery.update_line(line_id, routes)
+	return ([arrival for station, arrival in routes[0] if isinstance(station, Station)],
+	        [arrival for station, arrival in routes[1] if isinstance(station, Station)])
 
 
 
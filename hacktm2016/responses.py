@@ -0,0 +1,84 @@
+import gzip
+import hashlib
+from typing import Any, Callable, Dict, Hashable
+
+from flask import Response, json, request
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+
+class SerializedResponse:
+	"""
+	JSON body serialized once for a given version of the source data, with lazily compressed variants.
+	"""
+
+	def __init__(self, source: Any, body: bytes):
+		self.source = source
+		self.body = body
+		self.etag = hashlib.sha1(body).hexdigest()
+		self._encoded = {'identity': body}  # type: Dict[str, bytes]
+
+	def encoded(self, encoding: str) -> bytes:
+		body = self._encoded.get(encoding, None)
+		if body is None:
+			if encoding == 'br':
+				body = brotli.compress(self.body)
+			elif encoding == 'gzip':
+				body = gzip.compress(self.body)
+			else:
+				raise ValueError("unsupported encoding %r" % encoding)
+			self._encoded[encoding] = body
+
+		return body
+
+
+_serialized = {}  # type: Dict[Hashable, SerializedResponse]
+
+
+def _preferred_encoding() -> str:
+	if brotli is not None and request.accept_encodings['br']:
+		return 'br'
+	if request.accept_encodings['gzip']:
+		return 'gzip'
+	return 'identity'
+
+
+def cached_json(key: Hashable, source: Any, build: Callable[[Any], Any], max_age: int, stale: bool = False) -> Response:
+	"""
+	Respond with the JSON serialization of `build(source)`, reusing the serialized bytes for as long as `source` is
+	the same object, i.e. until the cache holding it is refreshed.
+
+	Responses carry a strong ETag and Cache-Control header; a request with a matching If-None-Match gets 304.
+
+	Parameters
+	----------
+	key identifies the endpoint and any parameters affecting the response
+	source cached data the response is built from
+	build function turning `source` into a JSON-serializable object
+	max_age how long clients may reuse the response without revalidating, in seconds
+	stale whether `source` is known to be out of date; stale responses carry a Warning header and are not reused
+	"""
+	entry = _serialized.get(key, None)
+	if entry is None or entry.source is not source:
+		body = json.dumps(build(source), separators=(',', ':')).encode('utf-8')
+		entry = _serialized[key] = SerializedResponse(source, body)
+
+	encoding = _preferred_encoding()
+	# each content-coding is a different representation and needs its own strong validator
+	etag = entry.etag if encoding == 'identity' else "%s-%s" % (entry.etag, encoding)
+	if request.if_none_match.contains(etag):
+		response = Response(status=304)
+	else:
+		response = Response(entry.encoded(encoding), mimetype='application/json')
+		if encoding != 'identity':
+			response.headers['Content-Encoding'] = encoding
+
+	response.set_etag(etag)
+	response.headers['Cache-Control'] = 'public, max-age=%d' % (max_age if not stale else 0)
+	if stale:
+		response.headers['Warning'] = '110 - "Response is Stale"'
+	response.headers['Vary'] = 'Accept-Encoding'
+	return response
@@ -1,10 +1,14 @@
 """
-This script runs the hacktm2016 application using a development server.
+This script runs the hacktm2016 application using a development server; see server.py for production.
 """
 
+import logging
 from os import environ
 from init import app
-from gevent.wsgi import WSGIServer
+import data
+import gevent
+from gevent.pywsgi import WSGIServer
+from server import NoDelayHandler
 
 if __name__ == '__main__':
 	HOST = environ.get('SERVER_HOST', 'localhost')
@@ -13,6 +17,11 @@ if __name__ == '__main__':
 		PORT = int(environ.get('SERVER_PORT', '5555'))
 	except ValueError:
 		PORT = 5555
-	app.debug = True
-	server = WSGIServer((HOST, PORT), app)
+	app.debug = environ.get('FLASK_DEBUG', '1') == '1'
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+	gevent.spawn(data.get_routes)
+	for data_poller in data.pollers:
+		if data_poller.interval > 0:
+			data_poller.start()
+	server = WSGIServer((HOST, PORT), app, handler_class=NoDelayHandler)
 	server.serve_forever()
\ No newline at end of file
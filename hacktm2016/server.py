@@ -0,0 +1,199 @@
+"""
+Production server: pre-forks gevent workers sharing one listening socket.
+
+Usage: python server.py
+configured through the environment:
+	SERVER_HOST, SERVER_PORT  address to listen on (default: 0.0.0.0:5555)
+	SERVER_WORKERS  number of worker processes (default: number of CPUs)
+	SERVER_GRACEFUL_TIMEOUT  seconds given to in-flight requests on shutdown (default: 10)
+	SERVER_LOCK_FILE  lock electing the worker that scrapes upstream (default: in the temporary directory)
+	CACHE_SHARED  shared cache tier (default: a sqlite file next to the lock file)
+	HISTORY_FILE  arrival history recorded by the leader and read by every worker (default: history.db)
+
+Stations, lines, routes and the indexes derived from them are loaded once in the master before forking, so the
+workers share them copy-on-write. One worker, holding the lock file, polls the upstream servers; the others read the
+snapshots it writes to the shared cache tier, and take over the lock if it dies.
+
+SIGTERM or SIGINT stop the server gracefully: workers stop accepting connections and finish their requests.
+"""
+
+import fcntl
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+from os import environ
+from typing import Dict
+
+import gevent
+from gevent.pywsgi import WSGIHandler, WSGIServer
+
+logger = logging.getLogger(__name__)
+
+election_interval = 5  # seconds between attempts of a follower to become the leader
+leader_lock = None  # lock file held by the leader for as long as it lives
+
+
+class NoDelayHandler(WSGIHandler):
+	"""
+	Disables Nagle's algorithm on connections: pywsgi sends the headers and the body of a response separately, and
+	the body would otherwise wait for the delayed ACK of the headers on kept-alive connections (about 40ms).
+	"""
+
+	def handle(self):
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return super().handle()
+
+
+def preload():
+	"""
+	Load the static data and build the indexes derived from it, in the master before forking.
+	"""
+	import data
+
+	# the master never scrapes; in particular it must not leave a rediscovery pending for every worker to inherit
+	data.set_leader(False)
+	data.get_stations()
+	data.get_lines()
+	data.get_routes()
+	data.get_stations_index()
+	data.get_station_routes_index()
+	data.get_transit_graph()
+	# keep the collector from touching (and so copying) the preloaded objects in every worker
+	if hasattr(gc, 'freeze'):
+		gc.freeze()
+
+
+def elect(lock_file: str):
+	"""
+	Make this worker the leader as soon as it can lock `lock_file`; the lock is released by the kernel when the
+	worker exits, letting another worker take over.
+	"""
+	global leader_lock
+	import data
+
+	lock = open(lock_file, 'a')
+	while True:
+		try:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			gevent.sleep(election_interval)
+			continue
+
+		leader_lock = lock
+		logger.info("event=leader_elected pid=%d", os.getpid())
+		data.set_leader(True)
+		for data_poller in data.pollers:
+			# refresh right away instead of waiting for the shared snapshots to go stale
+			gevent.spawn(data_poller.refresh_all)
+		if data.routes_stale:
+			gevent.spawn(data._discover_routes_quietly)
+		return
+
+
+def run_worker(listener: socket.socket, lock_file: str, graceful_timeout: float):
+	import data
+	import upstream
+	from init import app
+
+	upstream.reset()
+	if data.cache.shared is not None:
+		data.cache.shared.reconnect()
+	if data.arrival_history is not None:
+		data.arrival_history.reconnect()
+	data.set_leader(False)
+	for data_poller in data.pollers:
+		if data_poller.interval > 0:
+			data_poller.start()
+	election = gevent.spawn(elect, lock_file)
+
+	server = WSGIServer(listener, app, handler_class=NoDelayHandler)
+
+	def shutdown():
+		logger.info("event=worker_stopping pid=%d", os.getpid())
+		election.kill()
+		for data_poller in data.pollers:
+			data_poller.stop()
+		server.stop(timeout=graceful_timeout)
+
+	gevent.signal_handler(signal.SIGTERM, shutdown)
+	gevent.signal_handler(signal.SIGINT, shutdown)
+	server.serve_forever()
+
+
+def main():
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(levelname)s %(name)s %(message)s')
+	host = environ.get('SERVER_HOST', '0.0.0.0')
+	port = int(environ.get('SERVER_PORT', '5555'))
+	workers = int(environ.get('SERVER_WORKERS', '0')) or os.cpu_count() or 1
+	graceful_timeout = float(environ.get('SERVER_GRACEFUL_TIMEOUT', '10'))
+	lock_file = environ.get('SERVER_LOCK_FILE', os.path.join(tempfile.gettempdir(), 'hacktm2016-%d.lock' % port))
+	environ.setdefault('CACHE_SHARED', 'sqlite://%s.cache.db' % os.path.splitext(lock_file)[0])
+
+	# patches the standard library for gevent before anything else uses it
+	import init
+
+	preload()
+
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind((host, port))
+	listener.listen(1024)
+	logger.info("event=listening address=%s:%d workers=%d", host, port, workers)
+
+	master_pid = os.getpid()
+	children = {}  # type: Dict[int, int]
+	stopping = False
+
+	def spawn(index: int):
+		pid = os.fork()
+		if pid == 0:
+			try:
+				run_worker(listener, lock_file, graceful_timeout)
+			except Exception:
+				logger.exception("event=worker_crashed pid=%d", os.getpid())
+				os._exit(1)
+			os._exit(0)
+		children[pid] = index
+
+	def kill_remaining():
+		for pid in list(children):
+			logger.warning("event=worker_killed pid=%d", pid)
+			os.kill(pid, signal.SIGKILL)
+
+	def stop():
+		nonlocal stopping
+		# forked workers inherit this handler along with the event loop
+		if os.getpid() != master_pid or stopping:
+			return
+		stopping = True
+		logger.info("event=master_stopping")
+		for pid in children:
+			os.kill(pid, signal.SIGTERM)
+		gevent.spawn_later(graceful_timeout + 5, kill_remaining)
+
+	gevent.signal_handler(signal.SIGTERM, stop)
+	gevent.signal_handler(signal.SIGINT, stop)
+
+	for index in range(workers):
+		spawn(index)
+
+	while children:
+		try:
+			pid, status = os.waitpid(-1, 0)
+		except ChildProcessError:
+			break
+		index = children.pop(pid, None)
+		if index is not None and not stopping:
+			logger.warning("event=worker_exited pid=%d status=%d", pid, status)
+			spawn(index)
+
+	listener.close()
+	sys.exit(0)
+
+
+if __name__ == '__main__':
+	main()
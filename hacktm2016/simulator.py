@@ -0,0 +1,261 @@
+"""
+Local stand-in for the upstream servers (infotrafic, the ratt.ro txt api and velotm), for load tests and benchmarks
+that must not hit the real servers.
+
+Usage: python simulator.py [--port PORT] [--recordings DIR] [--latency SECONDS] [--jitter SECONDS]
+                           [--failure-rate RATE]
+       python simulator.py --record DIR
+
+Responses are replayed from recordings (files named after the upstream path and query, e.g. sens0.php?param1=1106.html
+or Station/Read.json) when available, and synthesized from the known lines and stations otherwise. Point the
+application at the simulator with:
+
+    INFOTRAFIC_URL=http://localhost:PORT/html/timpi/ RATT_TXT_URL=http://localhost:PORT/txt/ VELO_URL=http://localhost:PORT/
+"""
+
+import argparse
+import csv
+import html
+import os
+import random
+from typing import Any, Dict, List, Optional
+
+import flask
+import gevent
+from gevent.pywsgi import WSGIServer
+
+import data
+import ratt
+import upstream
+import velo
+from server import NoDelayHandler
+
+index_pages = {'tram.php': 'tram', 'trol.php': 'trolley', 'auto.php': 'bus'}
+
+
+def line_stations() -> Dict[int, List[ratt.Station]]:
+	"""
+	Stations of every known line in the order of the known stations file, which lists the stations of a line along
+	its first route.
+	"""
+	stations = {station.station_id: station for station in data.get_stations().values()}
+	line_ids = {line.line_id for line in data.get_lines()}
+	result = {}  # type: Dict[int, List[ratt.Station]]
+	with open(data.known_stations_csv, newline='') as csvfile:
+		for row in csv.reader(csvfile):
+			try:
+				line_id, station_id = int(row[0]), int(row[2])
+			except (IndexError, ValueError):
+				continue
+			if line_id in line_ids and station_id in stations:
+				result.setdefault(line_id, []).append(stations[station_id])
+
+	return result
+
+
+def synthetic_arrival(rng: random.Random) -> str:
+	return rng.choice(["%d min." % rng.randint(1, 40), "%02d:%02d" % (rng.randint(0, 23), rng.randint(0, 59)), ">>",
+	                   "**:**"])
+
+
+def synthetic_index_page(lines: List[ratt.Line]) -> str:
+	"""
+	Build an index page with the layout of http://86.122.170.105:61978/html/timpi/tram.php: a link to the page of
+	every line of one type.
+	"""
+	parts = ["<html><body><div>"]
+	for line in lines:
+		parts.append('<p><a href="sens0.php?param1=%d" title="%s"><img src="%s.png" alt="%s"></a></p>'
+		             % (line.line_id, html.escape(line.line_name), line.line_id, html.escape(line.line_name)))
+	parts.append("</div></body></html>")
+	return "\n".join(parts)
+
+
+def synthetic_infotrafic_page(line: ratt.Line, stations: List[ratt.Station], rng: random.Random = random) -> str:
+	"""
+	Build a line page with the layout of http://86.122.170.105:61978/html/timpi/sens0.php: a header table per route,
+	followed by one table per station with the line name, station name and arrival time in bold.
+	"""
+	parts = ["<html><head><title>Linia %s</title></head><body>" % line.line_name]
+	for route_name, route_stations in ((line.route_name_1, stations), (line.route_name_2, stations[::-1])):
+		parts.append('<table bgcolor="0000FF" width="100%%"><tr><td><b>Sens: %s</b></td></tr></table>' % route_name)
+		for station in route_stations:
+			parts.append('<table bgcolor="00BFFF" width="100%%"><tr><td><b>%s</b></td><td><b>%s</b></td>'
+			             '<td align="right"><b>%s</b></td></tr></table>'
+			             % (line.line_name, html.escape(station.raw_name), synthetic_arrival(rng)))
+	parts.append("</body></html>")
+	return "\n".join(parts)
+
+
+def synthetic_station_time_page(line: Optional[ratt.Line], rng: random.Random) -> str:
+	"""
+	Build a page with the layout of http://www.ratt.ro/txt/afis_msg.php: the line name and the next two arrivals.
+	"""
+	return ("<html><body>Linia: %s<br>Sosire1: %s<br>Sosire2: %s<br></body></html>"
+	        % (line.line_name if line is not None else '?', synthetic_arrival(rng), synthetic_arrival(rng)))
+
+
+def synthetic_bike_stations(rng: random.Random) -> Dict[str, Any]:
+	"""
+	Build a response with the layout of http://velotm.ro/Station/Read, with bike stations near the known stations.
+	"""
+	located = [station for station in data.get_stations().values() if station.lat is not None]
+	bike_stations = []
+	for station_id, station in enumerate(rng.sample(located, min(30, len(located))), start=1):
+		total = rng.randint(10, 20)
+		bike_stations.append({'Id': station_id, 'StationName': station.friendly_name, 'Latitude': station.lat + 0.001,
+		                      'Longitude': station.lng + 0.001, 'MaximumNumberOfBikes': total,
+		                      'EmptySpots': rng.randint(0, total), 'Status': rng.choice(['Functionala', 'Offline'])})
+	return {'Data': bike_stations, 'Total': len(bike_stations)}
+
+
+class Simulator:
+	"""
+	WSGI application serving the upstream pages, with a configurable latency and failure rate.
+
+	Parameters
+	----------
+	recordings directory with recorded responses, or None to synthesize all responses
+	latency mean delay before every response, in seconds
+	jitter maximum random deviation from `latency`, in seconds
+	failure_rate fraction of requests answered with 503 Service Unavailable
+	"""
+
+	def __init__(self, recordings: str = None, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0,
+	             seed: int = 2016):
+		self.recordings = recordings
+		self.latency = latency
+		self.jitter = jitter
+		self.failure_rate = failure_rate
+		self.rng = random.Random(seed)
+		self.lines = {line.line_id: line for line in data.get_lines()}
+		self.line_stations = line_stations()
+		self.requests = {}  # type: Dict[str, int]
+		self.failures = 0
+
+		self.app = flask.Flask(__name__)
+		self.app.add_url_rule('/html/timpi/<page>', 'infotrafic', self.infotrafic)
+		self.app.add_url_rule('/txt/afis_msg.php', 'station_time', self.station_time)
+		self.app.add_url_rule('/Station/Read', 'bike_stations', self.bike_stations, methods=['GET', 'POST'])
+		self.app.add_url_rule('/stats', 'stats', lambda: flask.jsonify(self.stats()))
+		self.app.before_request(self.simulate_conditions)
+
+	def simulate_conditions(self):
+		path = flask.request.path
+		self.requests[path] = self.requests.get(path, 0) + 1
+		if path == '/stats':
+			return None
+
+		delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+		if delay > 0:
+			gevent.sleep(delay)
+		if self.rng.random() < self.failure_rate:
+			self.failures += 1
+			return flask.Response("simulated failure", status=503)
+		return None
+
+	def recorded(self, name: str) -> Optional[str]:
+		if self.recordings is None:
+			return None
+		filename = os.path.join(self.recordings, name)
+		if not os.path.exists(filename):
+			return None
+		with open(filename, encoding='utf-8') as recording:
+			return recording.read()
+
+	def infotrafic(self, page: str):
+		if page == 'sens0.php':
+			line_id = flask.request.args.get('param1', type=int)
+			body = self.recorded('sens0.php?param1=%s.html' % line_id)
+			if body is None:
+				if line_id not in self.lines:
+					flask.abort(404)
+				body = synthetic_infotrafic_page(self.lines[line_id], self.line_stations.get(line_id, []), self.rng)
+		elif page in index_pages:
+			body = self.recorded(page + '.html')
+			if body is None:
+				body = synthetic_index_page([line for line in self.lines.values()
+				                             if line.line_type == index_pages[page] and line.line_id in self.line_stations])
+		else:
+			flask.abort(404)
+
+		return flask.Response(body, mimetype='text/html')
+
+	def station_time(self):
+		line_id = flask.request.args.get('id_traseu', type=int)
+		station_id = flask.request.args.get('id_statie', type=int)
+		body = self.recorded('afis_msg.php?id_traseu=%s&id_statie=%s.html' % (line_id, station_id))
+		if body is None:
+			body = synthetic_station_time_page(self.lines.get(line_id, None), self.rng)
+		return flask.Response(body, mimetype='text/html')
+
+	def bike_stations(self):
+		body = self.recorded('Station/Read.json')
+		if body is None:
+			body = flask.json.dumps(synthetic_bike_stations(self.rng))
+		return flask.Response(body, mimetype='application/json')
+
+	def stats(self) -> Dict[str, Any]:
+		return {'requests': self.requests, 'failures': self.failures}
+
+	def serve(self, host: str = 'localhost', port: int = 0) -> WSGIServer:
+		"""
+		Start serving in the background; the bound port is in `server.server_port`.
+		"""
+		server = WSGIServer((host, port), self.app, log=None, handler_class=NoDelayHandler)
+		server.start()
+		return server
+
+
+def record(directory: str):
+	"""
+	Save the responses of the real upstream servers in `directory`, in the layout the simulator replays.
+	"""
+	os.makedirs(os.path.join(directory, 'Station'), exist_ok=True)
+
+	def save(name: str, text: str):
+		with open(os.path.join(directory, name), 'w', encoding='utf-8') as recording:
+			recording.write(text)
+
+	for page in index_pages:
+		save(page + '.html', upstream.get(ratt.infotrafic_url + page).text)
+
+	stations = line_stations()
+	line_ids = list(stations)
+	for line_id, response in zip(line_ids, upstream.get_all(
+			[(ratt.infotrafic_url + 'sens0.php', {'param1': line_id}) for line_id in line_ids], size=6)):
+		if response is not None:
+			save('sens0.php?param1=%d.html' % line_id, response.text)
+
+	pairs = [(line_id, station.station_id) for line_id in line_ids for station in stations[line_id]]
+	for (line_id, station_id), response in zip(pairs, upstream.get_all(
+			[(ratt.station_time_url, {'id_traseu': line_id, 'id_statie': station_id}) for line_id, station_id in pairs],
+			size=20)):
+		if response is not None:
+			save('afis_msg.php?id_traseu=%d&id_statie=%d.html' % (line_id, station_id), response.text)
+
+	save('Station/Read.json', upstream.post(velo.velo_url + 'Station/Read').text)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve simulated upstream responses.")
+	parser.add_argument('--port', type=int, default=5556)
+	parser.add_argument('--recordings', help="directory with recorded responses")
+	parser.add_argument('--latency', type=float, default=0.0, help="mean response delay in seconds")
+	parser.add_argument('--jitter', type=float, default=0.0, help="maximum deviation from the mean delay in seconds")
+	parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of requests failing with 503")
+	parser.add_argument('--record', metavar='DIR', help="record the real upstream responses to DIR and exit")
+	args = parser.parse_args()
+
+	if args.record:
+		record(args.record)
+		return
+
+	simulator = Simulator(args.recordings, args.latency, args.jitter, args.failure_rate)
+	server = simulator.serve('localhost', args.port)
+	print("simulating upstream servers on http://localhost:%d/" % server.server_port, flush=True)
+	server.serve_forever()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,65 @@
+import functools
+from typing import Any, Callable, Dict, Hashable
+
+from gevent.event import AsyncResult
+
+
+class SingleFlight:
+	"""
+	Deduplicates concurrent calls: while a call for a key is in flight, other callers asking for the same key wait
+	for its result instead of starting their own.
+	"""
+
+	def __init__(self):
+		self._in_flight = {}  # type: Dict[Hashable, AsyncResult]
+		self.calls = {}  # type: Dict[str, int]
+		self.coalesced = {}  # type: Dict[str, int]
+
+	def do(self, name: str, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+		"""
+		Call `func(*args, **kwargs)` unless a call with the same `key` is already in flight, in which case wait for
+		and return (or raise) its result.
+
+		Parameters
+		----------
+		name name under which the call is counted in the statistics
+		key deduplication key; must identify the call completely
+		func function performing the actual work
+		"""
+		self.calls[name] = self.calls.get(name, 0) + 1
+		in_flight = self._in_flight.get(key, None)
+		if in_flight is not None:
+			self.coalesced[name] = self.coalesced.get(name, 0) + 1
+			return in_flight.get()
+
+		result = self._in_flight[key] = AsyncResult()
+		try:
+			value = func(*args, **kwargs)
+		except BaseException as e:
+			result.set_exception(e)
+			raise
+		else:
+			result.set(value)
+			return value
+		finally:
+			del self._in_flight[key]
+
+	def stats(self) -> Dict[str, Dict[str, int]]:
+		return {name: {'calls': calls, 'coalesced': self.coalesced.get(name, 0)} for name, calls in self.calls.items()}
+
+
+default = SingleFlight()
+
+
+def coalesce(func: Callable[..., Any]) -> Callable[..., Any]:
+	"""
+	Decorator deduplicating concurrent calls of `func` with the same arguments.
+	"""
+	name = "%s.%s" % (func.__module__, func.__name__)
+
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		key = (name, args, tuple(sorted(kwargs.items())))
+		return default.do(name, key, func, *args, **kwargs)
+
+	return wrapper
@@ -0,0 +1,130 @@
+"""
+Persistent snapshot of the discovered network (stations, lines and routes), so that a fresh worker can answer
+route queries without scraping infotrafic first.
+
+Usage: python snapshot.py [FILE]
+builds the snapshot offline by scraping infotrafic, and writes it to FILE (default: $SNAPSHOT_FILE or snapshot.db)
+"""
+
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+import ratt
+
+# incremented whenever the layout of the snapshot changes; snapshots of other versions are ignored
+SNAPSHOT_VERSION = 1
+
+
+class Snapshot:
+	def __init__(self, stations: Dict[str, ratt.Station], lines: List[ratt.Line],
+	             routes: Dict[int, Tuple[ratt.Route, ratt.Route]], created_at: float):
+		self.stations = stations
+		self.lines = lines
+		self.routes = routes
+		self.created_at = created_at
+
+	@property
+	def age(self) -> float:
+		return time.time() - self.created_at
+
+
+def save(filename: str, stations: Dict[str, ratt.Station], lines: List[ratt.Line],
+         routes: Dict[int, Tuple[ratt.Route, ratt.Route]]):
+	"""
+	Write a snapshot to `filename`, replacing any existing snapshot atomically.
+	"""
+	tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+	if os.path.exists(tmp_filename):
+		os.remove(tmp_filename)
+
+	db = sqlite3.connect(tmp_filename)
+	try:
+		db.executescript("""
+			CREATE TABLE meta (version INTEGER, created_at REAL);
+			CREATE TABLE stations (station_id INTEGER, raw_name TEXT PRIMARY KEY, friendly_name TEXT,
+			                       junction_name TEXT, lat REAL, lng REAL, poi_url TEXT);
+			CREATE TABLE lines (line_id INTEGER PRIMARY KEY, line_name TEXT, friendly_name TEXT, line_type TEXT,
+			                    route_name_1 TEXT, route_name_2 TEXT);
+			CREATE TABLE routes (line_id INTEGER, route_id INTEGER, route_name TEXT, PRIMARY KEY (line_id, route_id));
+			CREATE TABLE route_stations (line_id INTEGER, route_id INTEGER, position INTEGER, raw_name TEXT,
+			                             PRIMARY KEY (line_id, route_id, position));
+		""")
+		db.execute("INSERT INTO meta VALUES (?, ?)", (SNAPSHOT_VERSION, time.time()))
+
+		all_stations = dict(stations)
+		for line_routes in routes.values():
+			for route in line_routes:
+				for station in route.stations:
+					all_stations.setdefault(station.raw_name, station)
+
+		db.executemany("INSERT INTO stations VALUES (?, ?, ?, ?, ?, ?, ?)", [
+			(station.station_id, station.raw_name, station.friendly_name, station.junction_name, station.lat,
+			 station.lng, station.poi_url) for station in all_stations.values()
+		])
+		db.executemany("INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)", [
+			(line.line_id, line.line_name, line.friendly_name, line.line_type, line.route_name_1, line.route_name_2)
+			for line in lines
+		])
+		db.executemany("INSERT INTO routes VALUES (?, ?, ?)", [
+			(route.line_id, route.route_id, route.route_name) for line_routes in routes.values() for route in line_routes
+		])
+		db.executemany("INSERT INTO route_stations VALUES (?, ?, ?, ?)", [
+			(route.line_id, route.route_id, position, station.raw_name)
+			for line_routes in routes.values() for route in line_routes
+			for position, station in enumerate(route.stations)
+		])
+		db.commit()
+	finally:
+		db.close()
+
+	os.replace(tmp_filename, filename)
+
+
+def load(filename: str) -> Optional[Snapshot]:
+	"""
+	Read the snapshot stored in `filename`.
+
+	Returns
+	-------
+	The snapshot, or None if there is no usable snapshot of the current version
+	"""
+	if not os.path.exists(filename):
+		return None
+
+	db = sqlite3.connect(filename)
+	try:
+		version, created_at = db.execute("SELECT version, created_at FROM meta").fetchone()
+		if version != SNAPSHOT_VERSION:
+			return None
+
+		stations = {row[1]: ratt.Station(*row) for row in db.execute("SELECT * FROM stations")}
+		lines = [ratt.Line(*row) for row in db.execute("SELECT * FROM lines ORDER BY line_id")]
+
+		route_stations = {}  # type: Dict[Tuple[int, int], List[ratt.Station]]
+		for line_id, route_id, raw_name in db.execute(
+				"SELECT line_id, route_id, raw_name FROM route_stations ORDER BY line_id, route_id, position"):
+			route_stations.setdefault((line_id, route_id), []).append(stations[raw_name])
+
+		line_routes = {}  # type: Dict[int, List[ratt.Route]]
+		for line_id, route_id, route_name in db.execute("SELECT * FROM routes ORDER BY line_id, route_id"):
+			route = ratt.Route(route_id, route_name, line_id, route_stations.get((line_id, route_id), []))
+			line_routes.setdefault(line_id, []).append(route)
+	except (sqlite3.DatabaseError, TypeError, KeyError):
+		return None
+	finally:
+		db.close()
+
+	return Snapshot(stations, lines, {line_id: tuple(routes) for line_id, routes in line_routes.items()}, created_at)
+
+
+if __name__ == '__main__':
+	import sys
+	import data
+
+	output = sys.argv[1] if len(sys.argv) > 1 else data.snapshot_file
+	started = time.time()
+	save(output, data.get_stations(), data.get_lines(),
+	     ratt.get_route_info_from_infotraffic(data.known_lines_csv, data.known_stations_csv))
+	print("snapshot written to %s in %.1fs" % (output, time.time() - started))
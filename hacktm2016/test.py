@@ -0,0 +1,63 @@
+"""
+Tests of the infotrafic line page parsers, on the pages in fixtures/ which follow the layout of
+http://86.122.170.105:61978/html/timpi/sens0.php.
+
+Usage: python -m unittest test
+"""
+
+import os
+import unittest
+
+import requests
+
+import ratt
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name: str) -> str:
+	with open(os.path.join(fixtures, name), encoding='utf-8') as f:
+		return f.read()
+
+
+class InfotraficRowsTest(unittest.TestCase):
+	def assertSameRows(self, name: str):
+		text = read_fixture(name)
+		rows = ratt._infotrafic_rows_fast(text)
+		self.assertIsNotNone(rows, "fast parser declined %s" % name)
+		self.assertEqual(rows, ratt._infotrafic_rows_bs4(text))
+		return rows
+
+	def test_layout(self):
+		rows = self.assertSameRows('sens0-layout.html')
+		self.assertEqual(rows[1], ('00BFFF', ['3', 'Gara de Nord 2tb', '2 min.']))
+		self.assertEqual(rows[3], ('00BFFF', ['3', 'P-ta I.Maniu 4', '>>']))
+
+	def test_entities(self):
+		rows = self.assertSameRows('sens0-entities.html')
+		self.assertEqual(rows[1], ('00BFFF', ['40', 'T.Grozavescu\xa01a', '3\xa0min.']))
+		self.assertEqual(rows[4], ('00BFFF', ['40', 'Cim. Eroilor <1tb>', '09:05']))
+
+	def test_upper_case_tags(self):
+		self.assertSameRows('sens0-uppercase.html')
+
+	def test_brackets_in_attribute_values(self):
+		rows = self.assertSameRows('sens0-attributes.html')
+		self.assertEqual(rows[1], ('00BFFF', ['8', 'Opre Gogu_2', '4 min.']))
+		self.assertEqual(rows[2], ('00BFFF', ['8', 'Pacii', '06:50']))
+		self.assertEqual(rows[3], ('00BFFF', ['8', 'Canton C.F.R_2', '7 min.']))
+
+	def test_unbalanced_tags_fall_back(self):
+		text = read_fixture('sens0-unbalanced.html')
+		self.assertIsNone(ratt._infotrafic_rows_fast(text))
+
+		response = requests.Response()
+		response.status_code = 200
+		response.encoding = 'utf-8'
+		response._content = text.encode('utf-8')
+		routes = ratt.parse_arrivals_from_infotrafic(1106, {}, response, include_unknown_stations=True)
+		self.assertEqual([station for station, arrival in routes[0]][:2], ['Gara de Nord 2tb', 'Pacii'])
+
+
+if __name__ == '__main__':
+	unittest.main()
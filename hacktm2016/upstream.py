@@ -0,0 +1,238 @@
+import logging
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import gevent
+import gevent.pool
+from gevent.lock import BoundedSemaphore
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import metrics
+
+# settings applied to hosts without an entry in `host_settings`
+default_settings = {
+	'pool_size': 10,  # connections kept alive per host
+	'concurrency': 10,  # maximum requests in flight per host
+	'timeout': (5, 15),  # (connect, read) timeouts in seconds
+	'retries': 2,
+	'backoff': 0.3,  # retries wait backoff * 2 ** (retry - 1) seconds
+	'failure_threshold': 5,  # consecutive failures opening the circuit of a host
+	'reset_timeout': 30,  # seconds before an open circuit lets a trial request through
+	'rate': 0,  # requests per second allowed on average, or 0 for no budget
+	'burst': 10,  # requests allowed at once after an idle period when there is a budget
+}
+
+host_settings = {
+	'www.ratt.ro': {'pool_size': 20, 'concurrency': 20, 'rate': 10, 'burst': 40},
+	'86.122.170.105:61978': {'pool_size': 6, 'concurrency': 6, 'rate': 4, 'burst': 40},
+	'velotm.ro': {'pool_size': 2, 'concurrency': 2, 'rate': 0.5, 'burst': 2},
+}  # type: Dict[str, Dict[str, Any]]
+
+logger = logging.getLogger(__name__)
+
+request_seconds = metrics.histogram('upstream_request_duration_seconds', "Latency of requests to upstream hosts.",
+                                    ['host'], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+errors_total = metrics.counter('upstream_errors_total', "Failed requests to upstream hosts, by kind of failure.",
+                               ['host', 'kind'])
+throttled_seconds_total = metrics.counter('upstream_throttled_seconds_total',
+                                          "Time requests waited for the request budget of their upstream host.", ['host'])
+
+
+class CircuitOpenError(requests.ConnectionError):
+	"""
+	Raised instead of sending a request to a host whose circuit is open.
+	"""
+
+
+class Host:
+	"""
+	Connection pool, concurrency limit, circuit breaker and statistics for a single upstream host.
+
+	After `failure_threshold` consecutive failures (exceptions or 5xx responses) the circuit opens and requests fail
+	immediately with CircuitOpenError; after `reset_timeout` seconds a single trial request is let through, which
+	closes the circuit if it succeeds and opens it again otherwise.
+
+	With a `rate`, requests are also limited by a token bucket: on average `rate` requests per second, with bursts
+	of up to `burst` requests; requests over the budget wait for it. The budget is per process, which in a pre-forked
+	server (see server.py) is the leader doing the polling.
+	"""
+
+	def __init__(self, name: str, pool_size: int, concurrency: int, timeout: Tuple[float, float], retries: int,
+	             backoff: float, failure_threshold: int, reset_timeout: float, rate: float, burst: float):
+		self.name = name
+		self.timeout = timeout
+		self.session = requests.Session()
+		retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504), raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.concurrency = concurrency
+		self.semaphore = BoundedSemaphore(concurrency)
+		self.latency = request_seconds.labels(name)
+		self.errors = 0
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.consecutive_failures = 0
+		self.opened_at = None  # type: Optional[float]
+		self.probing = False
+		self.rejected = 0
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.tokens_at = time.time()
+		self.throttled = throttled_seconds_total.labels(name)
+
+	@property
+	def circuit(self) -> str:
+		if self.opened_at is None:
+			return 'closed'
+		return 'half_open' if self.probing or time.time() - self.opened_at >= self.reset_timeout else 'open'
+
+	def _check_circuit(self):
+		if self.opened_at is None:
+			return
+		if self.probing or time.time() - self.opened_at < self.reset_timeout:
+			self.rejected += 1
+			errors_total.labels(self.name, 'circuit_open').inc()
+			raise CircuitOpenError("circuit open for %s after %d consecutive failures"
+			                       % (self.name, self.consecutive_failures))
+		self.probing = True
+
+	def _record(self, failed: bool):
+		if not failed:
+			if self.opened_at is not None:
+				logger.info("event=circuit_closed host=%s", self.name)
+			self.consecutive_failures = 0
+			self.opened_at = None
+		else:
+			self.consecutive_failures += 1
+			if self.probing or (self.opened_at is None and self.consecutive_failures >= self.failure_threshold):
+				if self.opened_at is None:
+					logger.warning("event=circuit_opened host=%s failures=%d", self.name, self.consecutive_failures)
+				self.opened_at = time.time()
+		self.probing = False
+
+	def _spend_budget(self):
+		if self.rate <= 0:
+			return
+		while True:
+			now = time.time()
+			self.tokens = min(self.burst, self.tokens + (now - self.tokens_at) * self.rate)
+			self.tokens_at = now
+			if self.tokens >= 1:
+				self.tokens -= 1
+				return
+			wait = (1 - self.tokens) / self.rate
+			self.throttled.inc(wait)
+			gevent.sleep(wait)
+
+	def request(self, method: str, url: str, **kwargs) -> requests.Response:
+		self._check_circuit()
+		self._spend_budget()
+		kwargs.setdefault('timeout', self.timeout)
+		failed = True
+		try:
+			with self.semaphore:
+				started = time.time()
+				try:
+					response = self.session.request(method, url, **kwargs)
+				except requests.RequestException as e:
+					self.errors += 1
+					errors_total.labels(self.name, type(e).__name__).inc()
+					raise
+				finally:
+					self.latency.observe(time.time() - started)
+
+			if response.status_code >= 500:
+				self.errors += 1
+				errors_total.labels(self.name, 'http_%d' % response.status_code).inc()
+			else:
+				failed = False
+			return response
+		finally:
+			self._record(failed)
+
+	def stats(self) -> Dict[str, Any]:
+		return {'latency': self.latency.to_json(), 'errors': self.errors,
+		        'in_flight': self.concurrency - self.semaphore.counter, 'concurrency': self.concurrency,
+		        'circuit': self.circuit, 'consecutive_failures': self.consecutive_failures, 'rejected': self.rejected,
+		        'rate': self.rate, 'tokens': self.tokens, 'throttled_seconds': self.throttled.value}
+
+
+hosts = {}  # type: Dict[str, Host]
+
+metrics.gauge('upstream_requests_in_flight', "Requests in flight to each upstream host.", ['host'],
+              lambda: [((name,), host.concurrency - host.semaphore.counter) for name, host in hosts.items()])
+metrics.gauge('upstream_concurrency_limit', "Maximum requests in flight to each upstream host.", ['host'],
+              lambda: [((name,), host.concurrency) for name, host in hosts.items()])
+metrics.gauge('upstream_circuit_open', "Whether the circuit of each upstream host is open (1) or closed (0).", ['host'],
+              lambda: [((name,), int(host.circuit != 'closed')) for name, host in hosts.items()])
+
+
+def get_host(url: str) -> Host:
+	name = urlsplit(url).netloc
+	host = hosts.get(name, None)
+	if host is None:
+		settings = dict(default_settings, **host_settings.get(name, {}))
+		host = hosts[name] = Host(name, **settings)
+
+	return host
+
+
+def reset():
+	"""
+	Drop every host's connection pool and statistics; a forked process must call this before issuing requests, so
+	that it does not share connections with its parent.
+	"""
+	hosts.clear()
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+	"""
+	Issue a request through the shared connection pool of the url's host; arguments are as for `requests.request`.
+	"""
+	return get_host(url).request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+	return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+	return request('POST', url, **kwargs)
+
+
+def _get_quietly(url: str, params: Optional[Dict[str, Any]]) -> Optional[requests.Response]:
+	try:
+		return get(url, params=params)
+	except Exception as e:
+		logger.warning("event=upstream_request_failed url=%s error=%r", url, str(e))
+		return None
+
+
+def get_all(urls: Iterable[Tuple[str, Optional[Dict[str, Any]]]], size: int) -> List[Optional[requests.Response]]:
+	"""
+	GET many (url, params) pairs concurrently, at most `size` at a time.
+
+	Returns
+	-------
+	Responses in the order of `urls`, with None in place of requests that failed
+	"""
+	return list(gevent.pool.Pool(size).imap(lambda url: _get_quietly(*url), urls))
+
+
+def get_each(urls: Iterable[Tuple[str, Optional[Dict[str, Any]]]], size: int) -> Iterator[requests.Response]:
+	"""
+	GET many (url, params) pairs concurrently, at most `size` at a time, yielding responses as they complete and
+	skipping requests that failed.
+	"""
+	for response in gevent.pool.Pool(size).imap_unordered(lambda url: _get_quietly(*url), urls):
+		if response is not None:
+			yield response
+
+
+def stats() -> Dict[str, Any]:
+	return {name: host.stats() for name, host in hosts.items()}
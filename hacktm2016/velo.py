@@ -1,10 +1,17 @@
-from typing import Sequence
+from os import environ
+from typing import Any, Dict, Sequence
 
-import requests
 from flask import json
 
+import upstream
+
+# base url of velotm, overridable to point at a simulator (see simulator.py)
+velo_url = environ.get('VELO_URL', 'http://velotm.ro/')
+
 
 class Station:
+	__slots__ = ('station_id', 'station_name', 'lat', 'lng', 'total_spots', 'empty_spots', 'is_online')
+
 	def __init__(self, station_id: int, station_name: str, lat: float, lng: float, total_spots: int,
 	             empty_spots: int, is_online: bool):
 		self.station_id = station_id
@@ -15,6 +22,10 @@ class Station:
 		self.empty_spots = empty_spots
 		self.is_online = is_online
 
+	def to_json(self) -> Dict[str, Any]:
+		return {'station_id': self.station_id, 'station_name': self.station_name, 'lat': self.lat, 'lng': self.lng,
+		        'total_spots': self.total_spots, 'empty_spots': self.empty_spots, 'is_online': self.is_online}
+
 	def __str__(self):
 		return self.station_name
 
@@ -33,7 +44,7 @@ class Station:
 
 
 def get_stations_from_velo() -> Sequence[Station]:
-	response = requests.post("http://velotm.ro/Station/Read")
+	response = upstream.post(velo_url + 'Station/Read')
 	response.raise_for_status()
 
 	data = json.loads(response.text)